@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the rl_mc solvers on the shipped problem and on generated
+grid worlds, written to a JSON file so runs of different versions can be
+compared:
+
+    python benchmark.py --sizes 32x32 100x100 --output before.json
+    python benchmark.py --sizes 32x32 100x100 --compare before.json
+
+Every record holds the wall time, the peak memory traced by tracemalloc
+(a second, traced run) and the work done: sweeps and backups per second
+for value iteration, moves per second for Q-learning, rollouts and batch
+policy evaluation, improvement steps for policy iteration.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import rl_mc
+
+FORMAT_VERSION = 1
+
+def measure(fn,memory=True):
+    """
+    Runs fn once for the wall time and, if memory, once more under
+    tracemalloc for the peak allocation
+    :return: result of the timed run, seconds and peak bytes (or None)
+    """
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter()-start
+    peak = None
+    if memory:
+        tracemalloc.start()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result,elapsed,peak
+
+def random_mdp(states,actions,successors,seed=None):
+    """
+    MDP with a random sparse transition dictionary
+    """
+    rng = np.random.default_rng(seed)
+    T = {}
+    for s in range(states):
+        for a in range(actions):
+            nxt = rng.choice(states,size=min(successors,states),replace=False)
+            for t,p in zip(nxt.tolist(),rng.dirichlet(np.ones(len(nxt)))):
+                T[(s,t,a)] = p
+    r = rng.normal(size=states).tolist()
+    return rl_mc.MDP(list(range(states)),r,list(range(actions)),T,0.9)
+
+def bench_world(name,world,args):
+    memory = not args.no_memory
+    n_states = world.map.rows*world.map.cols
+    base = {'world':name,'rows':world.map.rows,'cols':world.map.cols,
+            'states':n_states}
+    records = []
+
+    def record(solver,elapsed,peak,**metrics):
+        records.append(dict(base,solver=solver,time=elapsed,peak_bytes=peak,
+                            **metrics))
+
+    for method in args.methods:
+        _,elapsed,peak = measure(
+            lambda:world.compute_v_array(args.gamma,epsilon=args.epsilon,
+                                         method=method),memory)
+        stats = world.stats
+        # the synchronous solver keeps the plain name for --compare
+        record('compute_v' if method == 'jacobi' else 'compute_v-'+method,
+               elapsed,peak,sweeps=stats['sweeps'],backups=stats['backups'],
+               backups_per_s=stats['backups']/elapsed)
+
+    for workers in args.workers:
+        _,elapsed,peak = measure(
+            lambda:world.compute_v_parallel(args.gamma,epsilon=args.epsilon,
+                                            workers=workers),memory)
+        stats = world.stats
+        record('compute_v_parallel-%d'%workers,elapsed,peak,
+               workers=stats['workers'],sweeps=stats['sweeps'],
+               backups=stats['backups'],backups_per_s=stats['backups']/elapsed)
+
+    pi,elapsed,peak = measure(
+        lambda:world.compute_optimal_pi(args.gamma,epsilon=args.epsilon),
+        memory)
+    record('compute_optimal_pi',elapsed,peak)
+
+    _,elapsed,peak = measure(
+        lambda:world.compute_optimal_pi_array(args.gamma,epsilon=args.epsilon),
+        memory)
+    record('compute_optimal_pi_array',elapsed,peak)
+
+    def q_learn():
+        # both runs draw the same episodes
+        world.seed(args.seed)
+        return world.q_learn(args.alpha,args.gamma,args.episodes,args.steps)
+
+    learned,elapsed,peak = measure(q_learn,memory)
+    stats = world.stats
+    cells = [c for c in learned if world.accesible_cell(c)]
+    record('q_learn',elapsed,peak,episodes=args.episodes,
+           moves=stats['moves'],moves_per_s=stats['moves']/elapsed,
+           agreement=sum(learned[c] == pi[c] for c in cells)/max(len(cells),1))
+
+    def q_learn_replay():
+        world.seed(args.seed)
+        return world.q_learn_replay(args.replay_alpha,args.gamma,
+                                    args.replay_episodes,args.steps)
+
+    learned,elapsed,peak = measure(q_learn_replay,memory)
+    stats = world.stats
+    record('q_learn_replay',elapsed,peak,episodes=stats['episodes'],
+           moves=stats['moves'],moves_per_s=stats['moves']/elapsed,
+           converged=stats['converged'],
+           agreement=sum(learned[c] == pi[c] for c in cells)/max(len(cells),1))
+
+    world.seed(args.seed)
+    starts = world.rng.generator.choice(
+        np.flatnonzero(world.model.accesible),size=args.rollouts)
+    cols = world.map.cols
+
+    def rollouts():
+        moves = 0
+        for s in starts.tolist():
+            world.simulate(pi,args.horizon,(s%cols,s//cols),render=False)
+            moves += world.stats['moves']
+        return moves
+
+    moves,elapsed,peak = measure(rollouts,memory)
+    record('simulate',elapsed,peak,rollouts=args.rollouts,moves=moves,
+           moves_per_s=moves/elapsed)
+
+    def evaluate():
+        world.seed(args.seed)
+        return world.evaluate_policy(pi,args.evaluations,args.horizon)
+
+    result,elapsed,peak = measure(evaluate,memory)
+    moves = world.stats['moves']
+    record('evaluate_policy',elapsed,peak,episodes=args.evaluations,
+           moves=moves,moves_per_s=moves/elapsed,mean=result['mean'],
+           termination_rate=result['termination_rate'])
+    return records
+
+def bench_mdp(states,args):
+    memory = not args.no_memory
+    mdp = random_mdp(states,args.mdp_actions,args.mdp_successors,args.seed)
+    _,elapsed,peak = measure(lambda:mdp.policy_iteration([0]*states),memory)
+    return [{'world':'random-mdp-%d'%states,'states':states,
+             'actions':args.mdp_actions,'solver':'MDP.policy_iteration',
+             'time':elapsed,'peak_bytes':peak,
+             'iterations':mdp.stats['iterations']}]
+
+def run(args):
+    results = []
+    worlds = [(path,lambda path=path:rl_mc.MDPWorld(path,seed=args.seed)) \
+              for path in args.problems]
+    for size in args.sizes:
+        rows,cols = map(int,size.lower().split('x'))
+        worlds.append(('generated-'+size,
+                       lambda rows=rows,cols=cols:rl_mc.generate_world(
+                           rows,cols,obstacles=args.obstacles,
+                           terminals=args.terminals,noise=args.noise,
+                           seed=args.seed)))
+    for name,make in worlds:
+        print('world',name,file=sys.stderr)
+        results += bench_world(name,make(),args)
+    for states in args.mdp_states:
+        print('mdp',states,file=sys.stderr)
+        results += bench_mdp(states,args)
+    return {'format':FORMAT_VERSION,
+            'created':time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python':platform.python_version(),
+            'numpy':np.__version__,
+            'platform':platform.platform(),
+            'params':{k:v for k,v in vars(args).items() \
+                      if k not in ('output','compare')},
+            'results':results}
+
+def compare(current,previous,tolerance):
+    """
+    Prints the time ratio of every benchmark found in both runs
+    :return: the keys of the benchmarks slower than 1+tolerance
+    """
+    old = {(r['solver'],r['world']):r for r in previous['results']}
+    slower = []
+    for r in current['results']:
+        key = (r['solver'],r['world'])
+        if key not in old:
+            continue
+        ratio = r['time']/old[key]['time']
+        flag = ''
+        if ratio > 1+tolerance:
+            flag = '  REGRESSION'
+            slower.append(key)
+        print('%-22s %-28s %10.4fs %10.4fs %6.2fx%s'
+              %(key[0],key[1],old[key]['time'],r['time'],ratio,flag))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--problems',nargs='*',default=['problem-2.mdp'])
+    parser.add_argument('--sizes',nargs='*',
+                        default=['32x32','100x100','316x316'])
+    parser.add_argument('--obstacles',type=float,default=0.15)
+    parser.add_argument('--terminals',type=int,default=2)
+    parser.add_argument('--noise',type=float,default=0.3)
+    parser.add_argument('--gamma',type=float,default=0.95)
+    parser.add_argument('--epsilon',type=float,default=1.e-6)
+    parser.add_argument('--methods',nargs='*',
+                        default=['jacobi','gauss-seidel'],
+                        help='value iteration methods: jacobi, '
+                        'gauss-seidel, sor, anderson or prioritized (slow on '
+                        'large worlds)')
+    parser.add_argument('--workers',type=int,nargs='*',default=[],
+                        help='process counts of compute_v_parallel')
+    parser.add_argument('--alpha',type=float,default=0.1)
+    parser.add_argument('--episodes',type=int,default=2000)
+    parser.add_argument('--steps',type=int,default=200)
+    parser.add_argument('--replay-alpha',type=float,default=0.01,
+                        help='rate floor of q_learn_replay')
+    parser.add_argument('--replay-episodes',type=int,default=50000,
+                        help='episode budget of q_learn_replay, which stops '
+                        'early once its greedy policy settles')
+    parser.add_argument('--rollouts',type=int,default=200)
+    parser.add_argument('--horizon',type=int,default=1000)
+    parser.add_argument('--evaluations',type=int,default=10000,
+                        help='episodes of the batch policy evaluation')
+    parser.add_argument('--mdp-states',type=int,nargs='*',default=[100,1000])
+    parser.add_argument('--mdp-actions',type=int,default=10)
+    parser.add_argument('--mdp-successors',type=int,default=5)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--no-memory',action='store_true',
+                        help='skip the traced runs measuring peak memory')
+    parser.add_argument('--output',default='bench_results.json')
+    parser.add_argument('--compare',metavar='PREVIOUS',
+                        help='results file to compare the times with')
+    parser.add_argument('--tolerance',type=float,default=0.2,
+                        help='slowdown reported as a regression')
+    args = parser.parse_args(argv)
+
+    current = run(args)
+    with open(args.output,'w') as f:
+        json.dump(current,f,indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(current,previous,args.tolerance):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
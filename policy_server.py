@@ -0,0 +1,496 @@
+# -*- coding: utf-8 -*-
+"""
+Local policy query server: loads a solved PolicyTable once and answers
+JSON-lines lookups of the best action, V(s) or Q(s,.) of single cells or
+batches of them over TCP. The requests waiting at a time are coalesced
+into one vectorized lookup per kind, and a new table can be swapped in
+while clients are connected:
+
+    python policy_server.py problem-2.mdp --gamma 0.95 --port 8765
+    python policy_server.py --table policy.npz --watch --port 8765
+    python policy_server.py problem-2.mdp --bench
+
+Requests are one JSON object per line, answered in order on every
+connection:
+
+    {"id":1,"op":"action","cell":[3,4]}       -> {"id":1,"result":"NE"}
+    {"id":2,"op":"value","cells":[[3,4],[5,6]]} -> {"id":2,"result":[..,..]}
+    {"id":3,"op":"q","cell":[3,4]}            -> {"id":3,"result":[8 values]}
+    {"id":4,"op":"stats"}                     -> latency percentiles, ...
+
+and errors come back as {"id":..,"error":"..."}.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+
+import numpy as np
+
+import rl_mc
+
+LOOKUPS = {'action':lambda table,index:table.best_actions(index),
+           'value':lambda table,index:table.values(index),
+           'q':lambda table,index:table.action_values(index)}
+
+# longest request or answer line, about 500k cells of a batch
+LINE_LIMIT = 1<<23
+
+class PolicyError(Exception):
+    """
+    Error answered by the server to a request
+    """
+
+class LatencyLog:
+    """
+    Latencies of the last history requests, in seconds
+    """
+
+    def __init__(self,history=100000):
+        self.times = np.zeros(history)
+        self.count = 0
+
+    def add(self,seconds):
+        self.times[self.count%len(self.times)] = seconds
+        self.count += 1
+
+    def percentiles(self,q=(50,99)):
+        """
+        :return: {'p50':..,'p99':..} in seconds, None before any request
+        """
+        times = self.times[:min(self.count,len(self.times))]
+        if not len(times):
+            return {'p%g'%p:None for p in q}
+        return dict(zip(('p%g'%p for p in q),np.percentile(times,q).tolist()))
+
+class _Request:
+    __slots__ = ('rid','op','cells','single','future','start')
+
+    def __init__(self,rid,op,cells,single,future,start):
+        self.rid = rid
+        self.op = op
+        self.cells = cells
+        self.single = single
+        self.future = future
+        self.start = start
+
+class PolicyServer:
+    """
+    Serves the lookups of a PolicyTable. The table is only read, and
+    swap replaces it between two batches: a batch is answered entirely
+    from the table current when it started.
+    """
+
+    def __init__(self,table,max_batch=4096,history=100000):
+        """
+        :param max_batch: cells looked up together at most, a request
+        larger than that makes a batch on its own
+        :param history: requests kept for the latency percentiles
+        """
+        self.table = table
+        self.max_batch = max_batch
+        self.latency = LatencyLog(history)
+        self.batches = self.requests = self.cells = self.swaps = 0
+        self._queue = None
+        self._server = None
+        self._tasks = []
+
+    async def start(self,host='127.0.0.1',port=0):
+        """
+        Starts listening and returns the port, picked by the system if 0
+        """
+        self._queue = asyncio.Queue()
+        self._tasks.append(asyncio.create_task(self._batches()))
+        self._server = await asyncio.start_server(self._connection,host,port,
+                                                  limit=LINE_LIMIT)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        await self._server.serve_forever()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks,return_exceptions=True)
+        self._tasks = []
+
+    def swap(self,table):
+        """
+        Answers the next batches from table
+        """
+        self.table = table
+        self.swaps += 1
+
+    def start_watching(self,path,interval=1.0,**load_args):
+        """
+        Runs watch in a task that close cancels
+        """
+        self._tasks.append(asyncio.create_task(
+            self.watch(path,interval,**load_args)))
+
+    async def watch(self,path,interval=1.0,**load_args):
+        """
+        Swaps in the table saved at path every time the file changes,
+        keeping the current one if it can not be loaded
+        :param load_args: passed to PolicyTable.load
+        """
+        loop = asyncio.get_running_loop()
+        seen = None
+        while True:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime is not None and mtime != seen:
+                seen = mtime
+                try:
+                    # loaded off the event loop, which keeps answering
+                    table = await loop.run_in_executor(
+                        None,lambda:rl_mc.PolicyTable.load(path,**load_args))
+                except (OSError,ValueError,KeyError) as e:
+                    print('policy_server: not loading %s: %s'%(path,e),
+                          file=sys.stderr)
+                else:
+                    if table.version != self.table.version:
+                        self.swap(table)
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        """
+        Request, batch and swap counts, the table version and the p50 and
+        p99 latencies in seconds, from reading a request to its answer
+        """
+        stats = {'requests':self.requests,'cells':self.cells,
+                 'batches':self.batches,'swaps':self.swaps,
+                 'version':self.table.version}
+        stats.update(self.latency.percentiles())
+        return stats
+
+    def info(self):
+        table = self.table
+        return {'rows':table.rows,'cols':table.cols,'actions':table.actions,
+                'q':table.Q is not None,'version':table.version}
+
+    async def _connection(self,reader,writer):
+        # answers are written by a second task in the order of the
+        # requests, so a client can pipeline them
+        pending = asyncio.Queue()
+        answers = asyncio.create_task(self._answers(pending,writer))
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                future = loop.create_future()
+                pending.put_nowait(future)
+                self._parse(line,future)
+        except (ConnectionError,ValueError):
+            # ValueError: a line longer than LINE_LIMIT, the connection
+            # is closed once the earlier requests are answered
+            pass
+        finally:
+            pending.put_nowait(None)
+            await answers
+
+    async def _answers(self,pending,writer):
+        try:
+            while True:
+                future = await pending.get()
+                if future is None:
+                    break
+                writer.write(await future)
+                if pending.empty():
+                    await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def _parse(self,line,future):
+        start = time.perf_counter()
+        rid = None
+        try:
+            request = json.loads(line)
+            rid = request.get('id')
+            op = request.get('op')
+            if op == 'stats' or op == 'info':
+                answer = self.stats() if op == 'stats' else self.info()
+                future.set_result(_answer(rid,answer))
+                return
+            if op not in LOOKUPS:
+                raise ValueError('unknown op: %r'%(op,))
+            single = 'cell' in request
+            raw = [request['cell']] if single else request['cells']
+            cells = np.asarray(raw)
+            # floats are not truncated, integers beyond int64 come as
+            # objects, and bools (which numpy would take as 0 and 1 next
+            # to integers) are looked for in the pairs themselves
+            if cells.ndim != 2 or cells.shape[1] != 2 or \
+                    cells.dtype.kind not in 'iu' or \
+                    any(type(x) is bool or type(y) is bool for x,y in raw):
+                raise ValueError('cells must be integer [x,y] pairs')
+            cells = cells.astype(np.intp)
+        except Exception as e:
+            # every request is answered, or its connection would stall
+            future.set_result(_error(rid,e))
+            return
+        self._queue.put_nowait(_Request(rid,op,cells,single,future,start))
+
+    async def _batches(self):
+        queue = self._queue
+        while True:
+            batch = [await queue.get()]
+            # the readers with data waiting queue their requests too
+            await asyncio.sleep(0)
+            n = len(batch[0].cells)
+            while n < self.max_batch and not queue.empty():
+                request = queue.get_nowait()
+                batch.append(request)
+                n += len(request.cells)
+            self._answer_batch(batch)
+
+    def _answer_batch(self,batch):
+        table = self.table
+        groups = {}
+        for request in batch:
+            groups.setdefault(request.op,[]).append(request)
+        for op,requests in groups.items():
+            cells = np.concatenate([r.cells for r in requests])
+            index,inside = table.index(cells)
+            bounds = np.cumsum([0]+[len(r.cells) for r in requests])
+            try:
+                results = LOOKUPS[op](table,index).tolist()
+            except ValueError as e:
+                results = e
+            # requests with a cell outside the grid are answered an error
+            outside = np.add.reduceat(~inside,bounds[:-1]) \
+                      if not inside.all() else np.zeros(len(requests))
+            done = time.perf_counter()
+            for r,lo,hi,bad in zip(requests,bounds[:-1],bounds[1:],outside):
+                if isinstance(results,Exception):
+                    line = _error(r.rid,results)
+                elif bad:
+                    line = _error(r.rid,'cell outside the grid')
+                else:
+                    line = _answer(r.rid,
+                                   results[lo] if r.single else results[lo:hi])
+                if not r.future.done():
+                    r.future.set_result(line)
+                self.latency.add(done-r.start)
+            self.cells += len(cells)
+            self.requests += len(requests)
+        self.batches += 1
+
+def _answer(rid,result):
+    return (json.dumps({'id':rid,'result':result},
+                       separators=(',',':'))+'\n').encode()
+
+def _error(rid,error):
+    return (json.dumps({'id':rid,'error':str(error)},
+                       separators=(',',':'))+'\n').encode()
+
+class PolicyClient:
+    """
+    Connection to a PolicyServer. Requests of several coroutines share
+    the connection, each one waiting for its own answer.
+    """
+
+    def __init__(self,reader,writer):
+        self._reader = reader
+        self._writer = writer
+        self._waiting = deque()
+        self._next_id = 0
+        self._receiver = asyncio.create_task(self._receive())
+
+    @classmethod
+    async def connect(cls,host='127.0.0.1',port=8765):
+        reader,writer = await asyncio.open_connection(host,port,
+                                                      limit=LINE_LIMIT)
+        return cls(reader,writer)
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
+        await asyncio.gather(self._receiver,return_exceptions=True)
+
+    async def request(self,op,**fields):
+        """
+        :return: the result of the request
+        :raises PolicyError: with the error answered by the server
+        """
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append(future)
+        request = dict(fields,id=self._next_id,op=op)
+        self._writer.write((json.dumps(request,separators=(',',':'))
+                            +'\n').encode())
+        try:
+            await self._writer.drain()
+        except BaseException:
+            future.cancel()
+            raise
+        answer = await future
+        if 'error' in answer:
+            raise PolicyError(answer['error'])
+        return answer['result']
+
+    async def _receive(self):
+        # answers come in the order of the requests
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                future = self._waiting.popleft()
+                # the answer of a cancelled request is dropped
+                if not future.done():
+                    future.set_result(json.loads(line))
+        except ConnectionError:
+            pass
+        finally:
+            while self._waiting:
+                future = self._waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(
+                        'policy server closed the connection'))
+
+    async def action(self,x,y):
+        """
+        :return: best action name of (x,y), None where no action is taken
+        """
+        return await self.request('action',cell=[x,y])
+
+    async def actions(self,cells):
+        return await self.request('action',cells=[list(c) for c in cells])
+
+    async def value(self,x,y):
+        return await self.request('value',cell=[x,y])
+
+    async def values(self,cells):
+        return await self.request('value',cells=[list(c) for c in cells])
+
+    async def q(self,x,y):
+        """
+        :return: Q((x,y),a) of every action, in the order of info()
+        """
+        return await self.request('q',cell=[x,y])
+
+    async def qs(self,cells):
+        return await self.request('q',cells=[list(c) for c in cells])
+
+    async def stats(self):
+        return await self.request('stats')
+
+    async def info(self):
+        return await self.request('info')
+
+async def bench(table,clients=32,requests=2000,batch=64,seed=0):
+    """
+    In-process server with clients connections looking up random cells
+    one at a time, then in batches, swapping the table halfway
+    :return: client side p50/p99 latencies and requests per second of
+    both runs and the server stats
+    """
+    server = PolicyServer(table)
+    port = await server.start()
+    rng = np.random.default_rng(seed)
+    cells = np.stack([rng.integers(table.cols,size=requests),
+                      rng.integers(table.rows,size=requests)],axis=1).tolist()
+    conns = [await PolicyClient.connect(port=port) for _ in range(clients)]
+    result = {}
+    for name,size in (('single',1),('batch',batch)):
+        latency = LatencyLog(clients*requests)
+
+        async def run(client):
+            for i in range(0,requests,size):
+                start = time.perf_counter()
+                if size == 1:
+                    await client.action(*cells[i])
+                else:
+                    await client.actions(cells[i:i+size])
+                latency.add(time.perf_counter()-start)
+
+        async def swap():
+            await asyncio.sleep(0.01)
+            server.swap(rl_mc.PolicyTable(table.cols,table.actions,
+                                          table.policy,table.V,
+                                          None if table.Q is None \
+                                          else table.Q.T))
+
+        start = time.perf_counter()
+        await asyncio.gather(swap(),*(run(c) for c in conns))
+        elapsed = time.perf_counter()-start
+        result[name] = dict(latency.percentiles(),
+                            requests_per_s=latency.count/elapsed,
+                            cells_per_s=clients*requests/elapsed)
+    result['server'] = server.stats()
+    for client in conns:
+        await client.close()
+    await server.close()
+    return result
+
+async def serve(table,args):
+    server = PolicyServer(table,max_batch=args.max_batch)
+    port = await server.start(args.host,args.port)
+    print('serving %s on %s:%d'%(table.version,args.host,port),
+          file=sys.stderr)
+    if args.watch:
+        server.start_watching(args.table,args.interval,cols=args.cols)
+    try:
+        await server.serve_forever()
+    finally:
+        await server.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('world',nargs='?',help='.mdp file to solve')
+    parser.add_argument('--table',help='PolicyTable or SolutionCache .npz')
+    parser.add_argument('--cols',type=int,
+                        help='grid columns of a SolutionCache entry')
+    parser.add_argument('--gamma',type=float,default=0.95)
+    parser.add_argument('--epsilon',type=float,default=1.e-9)
+    parser.add_argument('--save',help='writes the solved table to a file')
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8765)
+    parser.add_argument('--max-batch',type=int,default=4096)
+    parser.add_argument('--watch',action='store_true',
+                        help='swap in the --table file whenever it changes')
+    parser.add_argument('--interval',type=float,default=1.0)
+    parser.add_argument('--bench',action='store_true',
+                        help='measure the latencies in process and exit')
+    parser.add_argument('--clients',type=int,default=32)
+    parser.add_argument('--requests',type=int,default=2000)
+    args = parser.parse_args(argv)
+    if args.world is not None:
+        world = rl_mc.MDPWorld(args.world)
+        table = world.policy_table(args.gamma,args.epsilon)
+        if args.save:
+            table.save(args.save)
+    elif args.table is not None:
+        table = rl_mc.PolicyTable.load(args.table,cols=args.cols)
+    else:
+        parser.error('a world or --table is needed')
+    if args.watch and args.table is None:
+        parser.error('--watch needs --table')
+    if args.bench:
+        print(json.dumps(asyncio.run(bench(table,args.clients,args.requests)),
+                         indent=1))
+        return 0
+    try:
+        asyncio.run(serve(table,args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -35,135 +35,309 @@ $
 
 import numpy as np #Importación de la librería NumPy, Numerical Python empleado para el manejo de arreglos multidimesionales
 
-T = np.matrix([[0.3,0.6],[0.7,0.4]]) #Creación de la matriz 2x2 T
+def calcula_dist(T,x_0,n):
+    x_n = np.matmul(np.linalg.matrix_power(T,n),x_0)
+    print('x(t+'+str(n)+')=\n'+str(x_n))
+    return x_n
+
+def _issparse(T):
+    # scipy.sparse matrices and arrays, without importing scipy
+    return type(T).__module__.startswith('scipy.sparse')
+
+class MarkovChain:
+    """
+    Markov chain with a column-stochastic transition matrix, x(t+1) = T x(t).
+    T may be dense (array or np.matrix) or a scipy.sparse matrix; large
+    chains should be sparse, every operation is then a sparse product.
+    Distributions are vectors of length n or (n,k) matrices holding k
+    distributions as columns, evolved all at once.
+    """
+
+    def __init__(self,T,validate=True,atol=1.e-8):
+        """
+        :param T: (n,n) transition matrix, T[t,s] = P(t|s)
+        :param validate: check that the columns are distributions
+        :param atol: tolerance of the column sums
+        """
+        if _issparse(T):
+            self.T = T.tocsr().astype(float)
+            self.sparse = True
+        else:
+            self.T = np.asarray(T,dtype=float)
+            self.sparse = False
+        if self.T.ndim != 2 or self.T.shape[0] != self.T.shape[1]:
+            raise ValueError('transition matrix must be square, found '+
+                             str(self.T.shape))
+        self.n_states = self.T.shape[0]
+        if validate:
+            sums = np.asarray(self.T.sum(axis=0)).ravel()
+            bad = np.flatnonzero(np.abs(sums-1) > atol)
+            if len(bad):
+                raise ValueError('column %d of the transition matrix sums to '
+                                 '%g'%(bad[0],sums[bad[0]]))
+            if (self.T.data if self.sparse else self.T).min(initial=0) < 0:
+                raise ValueError('negative transition probability')
+        # T^(2^k) for k = 0,1,...
+        self._squares = [self.T]
+        self.stats = {}
+
+    def step(self,x):
+        """
+        :param x: distribution vector or (n,k) matrix of distributions
+        :return: the distributions one step later
+        """
+        return self.T @ np.asarray(x,dtype=float)
+
+    def power(self,n):
+        """
+        T^n by repeated squaring; the squares are cached for later queries
+        """
+        P = None
+        for k in range(int(n).bit_length()):
+            if (n >> k) & 1:
+                P = self._square(k) if P is None else self._square(k) @ P
+        if P is None:
+            if self.sparse:
+                from scipy.sparse import identity
+                return identity(self.n_states,format='csr')
+            return np.eye(self.n_states)
+        return P
+
+    def _square(self,k):
+        while len(self._squares) <= k:
+            P = self._squares[-1]
+            self._squares.append(P @ P)
+        return self._squares[k]
+
+    def evolve(self,x,n,method='auto'):
+        """
+        Distributions after n steps
+        :param x: distribution vector or (n,k) matrix of distributions
+        :param n: number of steps
+        :param method: 'steps' multiplies n times by T, 'squaring' by the
+        cached squares T^(2^k) in the binary expansion of n, 'auto' picks
+        the cheaper one (always 'steps' for sparse chains, whose squares
+        fill in)
+        """
+        x = np.asarray(x,dtype=float)
+        if method == 'auto':
+            method = 'steps'
+            if not self.sparse:
+                batch = x.shape[1] if x.ndim == 2 else 1
+                missing = max(int(n).bit_length()-len(self._squares),0)
+                squaring = missing*self.n_states+bin(int(n)).count('1')*batch
+                if squaring < n*batch:
+                    method = 'squaring'
+        if method == 'steps':
+            for i in range(n):
+                x = self.T @ x
+        elif method == 'squaring':
+            for k in range(int(n).bit_length()):
+                if (n >> k) & 1:
+                    x = self._square(k) @ x
+        else:
+            raise ValueError('unknown method: '+str(method))
+        return x
+
+    def history(self,x,n):
+        """
+        :return: array with the distributions at times 0,1,...,n
+        """
+        x = np.asarray(x,dtype=float)
+        out = np.empty((n+1,)+x.shape)
+        out[0] = x
+        for i in range(n):
+            out[i+1] = x = self.T @ x
+        return out
+
+    def stationary(self,method='auto',tol=1.e-12,max_iter=100000,x0=None,
+                   lazy=False):
+        """
+        Stationary distribution, T x = x
+        :param method: 'power' iterates x = T x until the L1 change is
+        below tol, 'eigs' uses the sparse eigen-solver of scipy, 'eig'
+        the dense one; 'auto' is 'eig' for small dense chains and 'power'
+        otherwise
+        :param tol: convergence tolerance
+        :param max_iter: maximum number of power iterations
+        :param x0: initial distribution of the power iteration, uniform
+        by default
+        :param lazy: iterate (I+T)/2 instead, which has the same
+        stationary distribution and also converges on periodic chains
+        :return: the stationary distribution, normalized to sum 1
+        """
+        if method == 'auto':
+            method = 'eig' if not self.sparse and self.n_states <= 2000 \
+                     else 'power'
+        if method == 'power':
+            x = np.full(self.n_states,1./self.n_states) if x0 is None \
+                else np.asarray(x0,dtype=float).ravel()
+            residual = np.inf
+            iteration = 0
+            while residual > tol:
+                if iteration == max_iter:
+                    raise RuntimeError('power iteration did not converge in '
+                                       '%d iterations (residual %g)'
+                                       %(max_iter,residual))
+                x_next = self.T @ x
+                if lazy:
+                    x_next = 0.5*(x_next+x)
+                # renormalize against round-off drift
+                x_next /= x_next.sum()
+                residual = np.abs(x_next-x).sum()
+                x = x_next
+                iteration += 1
+        elif method == 'eigs':
+            from scipy.sparse.linalg import eigs
+            # 1 is the eigenvalue of largest real part of a stochastic matrix
+            l,v = eigs(self.T,k=1,which='LR',tol=tol)
+            x = v[:,0].real
+            iteration = None
+        elif method == 'eig':
+            T = self.T.toarray() if self.sparse else self.T
+            l,v = np.linalg.eig(T)
+            x = v[:,np.argmin(np.abs(l-1))].real
+            iteration = None
+        else:
+            raise ValueError('unknown method: '+str(method))
+        x = x/x.sum()
+        self.stats = {'method':method,'iterations':iteration,
+                      'residual':float(np.abs(self.T @ x-x).sum())}
+        return x
 
-print(T) #Imprimir T
 
-"""La evolución de la distribución de probabilidad $x$ para los dos estados esta dada por la ecuación:
+def demo_markov_chain():
+    T = np.matrix([[0.3,0.6],[0.7,0.4]]) #Creación de la matriz 2x2 T
 
+    print(T) #Imprimir T
 
-$
- x = T x
-$
+    """La evolución de la distribución de probabilidad $x$ para los dos estados esta dada por la ecuación:
+
+
+    $
+     x = T x
+    $
  
-Por ejemplo, si sabemos con certeza que estamos en el estado 1, se representa como:
+    Por ejemplo, si sabemos con certeza que estamos en el estado 1, se representa como:
  
-$
-x = 
-\begin{bmatrix}
-1\\
-0
-\end{bmatrix}
-$
+    $
+    x = 
+    \begin{bmatrix}
+    1\\
+    0
+    \end{bmatrix}
+    $
  
-Es decir la probabilidad de estar en el estado 1 es 1 y de estar en el estado 2 es 0.
+    Es decir la probabilidad de estar en el estado 1 es 1 y de estar en el estado 2 es 0.
  
-Si queremos saber como será la distribución de probabilidad para los estados en el tiempo siguiente hacemos:
-
-$x^{t+1} = 
-\begin{bmatrix}
-0.3&0.6\\
-0.7&0.4
-\end{bmatrix}
-\begin{bmatrix}
-1\\
-0
-\end{bmatrix}
-=
-\begin{bmatrix}
-0.3\\
-0.7
-\end{bmatrix}
-$
+    Si queremos saber como será la distribución de probabilidad para los estados en el tiempo siguiente hacemos:
+
+    $x^{t+1} = 
+    \begin{bmatrix}
+    0.3&0.6\\
+    0.7&0.4
+    \end{bmatrix}
+    \begin{bmatrix}
+    1\\
+    0
+    \end{bmatrix}
+    =
+    \begin{bmatrix}
+    0.3\\
+    0.7
+    \end{bmatrix}
+    $
  
-Es decir la probabilidad de estar en el estado 1 es 0.3 y de transitar al estado 2 es 0.7. 
-Si queremos saber que pasará dos tiempos en el futuro, iteramos la ecuación:
-
-$x^{t+2} = 
-\begin{bmatrix}
-0.3&0.6\\
-0.7&0.4
-\end{bmatrix}
-\begin{bmatrix}
-0.3&0.6\\
-0.7&0.4
-\end{bmatrix}
-\begin{bmatrix}
-1\\
-0
-\end{bmatrix}
-=
-\begin{bmatrix}
-0.3&0.6\\
-0.7&0.4
-\end{bmatrix}^2
-\begin{bmatrix}
-1\\
-0
-\end{bmatrix}
-$
+    Es decir la probabilidad de estar en el estado 1 es 0.3 y de transitar al estado 2 es 0.7. 
+    Si queremos saber que pasará dos tiempos en el futuro, iteramos la ecuación:
+
+    $x^{t+2} = 
+    \begin{bmatrix}
+    0.3&0.6\\
+    0.7&0.4
+    \end{bmatrix}
+    \begin{bmatrix}
+    0.3&0.6\\
+    0.7&0.4
+    \end{bmatrix}
+    \begin{bmatrix}
+    1\\
+    0
+    \end{bmatrix}
+    =
+    \begin{bmatrix}
+    0.3&0.6\\
+    0.7&0.4
+    \end{bmatrix}^2
+    \begin{bmatrix}
+    1\\
+    0
+    \end{bmatrix}
+    $
  
-Con ayuda de NumPy podemos resolver esta multiplicación de matrices:
-"""
+    Con ayuda de NumPy podemos resolver esta multiplicación de matrices:
+    """
 
-x = np.matrix([[1],[0]]) #Probabilidades de estados
-print('x =\n'+str(x)+'\n')
+    x = np.matrix([[1],[0]]) #Probabilidades de estados
+    print('x =\n'+str(x)+'\n')
 
-x_1 = np.matmul(T,x) #Multiplicación de la matriz de estados por la matriz de probabilidades de transición usando la función matmul() de NumPy.
-print('x(t+1)=\n'+str(x_1)+'\n')
+    x_1 = np.matmul(T,x) #Multiplicación de la matriz de estados por la matriz de probabilidades de transición usando la función matmul() de NumPy.
+    print('x(t+1)=\n'+str(x_1)+'\n')
 
-x_2 = np.matmul(T,x_1) #Multiplicación para calcular la probabilidad de estados a dos pasos de tiempo
-print('x(t+2)=\n'+str(x_2)+'\n')
+    x_2 = np.matmul(T,x_1) #Multiplicación para calcular la probabilidad de estados a dos pasos de tiempo
+    print('x(t+2)=\n'+str(x_2)+'\n')
 
-#Comprobar que el resultado anterior es el mismo que elevar la matriz $T$ al cuadrado y multiplicar por $x$ usando la función matrix_power() de NumPy.
-x_2= np.matmul(np.linalg.matrix_power(T,2),x)
-print('x(t+2)=\n'+str(x_2))
+    #Comprobar que el resultado anterior es el mismo que elevar la matriz $T$ al cuadrado y multiplicar por $x$ usando la función matrix_power() de NumPy.
+    x_2= np.matmul(np.linalg.matrix_power(T,2),x)
+    print('x(t+2)=\n'+str(x_2))
 
-"""Bajo ciertas condiciones, existe una distribución de probabilidad estacionaria sobre los estados.
-Esto significa que no importa cual sea la distribución de probabilidad inicial, al iterar la ecuación, la distribución converge a una distribución que no cambia. 
+    """Bajo ciertas condiciones, existe una distribución de probabilidad estacionaria sobre los estados.
+    Esto significa que no importa cual sea la distribución de probabilidad inicial, al iterar la ecuación, la distribución converge a una distribución que no cambia. 
 
-Por ejemplo, definamos un método calcula_dist() para encontrar la distribución de probabilidad al tiempo t ó $n$, dada una condición inicial $x_0$, empleando la misma matriz de probabilidad de transición de estados $T$:
-"""
-
-def calcula_dist(T,x_0,n):
-    x_n = np.matmul(np.linalg.matrix_power(T,n),x_0)
-    print('x(t+'+str(n)+')=\n'+str(x_n))
+    Por ejemplo, definamos un método calcula_dist() para encontrar la distribución de probabilidad al tiempo t ó $n$, dada una condición inicial $x_0$, empleando la misma matriz de probabilidad de transición de estados $T$:
+    """
 
 
-#Usemos esta función para encontrar la distribución al tiempo 5:
-x_10 = calcula_dist(T,x,10)
+    #Usemos esta función para encontrar la distribución al tiempo 5:
+    x_10 = calcula_dist(T,x,10)
 
-# Veamos como cambia la distribución con cada una de las iteraciones:
-for i in range(10):
-    calcula_dist(T,x,i)
-    print("\n")
+    # Veamos como cambia la distribución con cada una de las iteraciones:
+    for i in range(10):
+        calcula_dist(T,x,i)
+        print("\n")
 
-"""Observamos una rápida convergencia a los valores.
-¿Qué tanto tenemos que iterar la ecuación para encontrar la distribución?
-Esto puede resolverse más fácilmente si observamos que lo que queremos encontrar es $x^{\text{*}}$ tal que:
+    """Observamos una rápida convergencia a los valores.
+    ¿Qué tanto tenemos que iterar la ecuación para encontrar la distribución?
+    Esto puede resolverse más fácilmente si observamos que lo que queremos encontrar es $x^{\text{*}}$ tal que:
  
-$x^{\text{*}} = T x^{\text{*}}$
+    $x^{\text{*}} = T x^{\text{*}}$
 
-Esto es equivalente a resolver el problema de encontrar los vectores característicos de la matriz $T$.
+    Esto es equivalente a resolver el problema de encontrar los vectores característicos de la matriz $T$.
 
-Los vectores característicos de una matriz, también conocidos como eigenvectores,  son aquellos que no cambian de dirección cuando se aplica la transformación lineal $T$ (es decir cuando se multiplica por $T$).
+    Los vectores característicos de una matriz, también conocidos como eigenvectores,  son aquellos que no cambian de dirección cuando se aplica la transformación lineal $T$ (es decir cuando se multiplica por $T$).
 
-Usando NumPy podemos encontrar el eigenvector de una matriz, usando la función linalg.eig():
-"""
+    Usando NumPy podemos encontrar el eigenvector de una matriz, usando la función linalg.eig():
+    """
 
-#La función linalg.eg() regresa un tupple con un vector y una matriz. El vector corresponde a los eigenevalores y la matriz a los eigenvectores
+    #La función linalg.eg() regresa un tupple con un vector y una matriz. El vector corresponde a los eigenevalores y la matriz a los eigenvectores
 
-l,v = np.linalg.eig(T)
-print("Eigenvalores de matriz T:\n"+str(l))
-print("\n")
-print("Eigenvectores de matriz T:\n"+str(v)) #Eigenvectores de matriz T
+    l,v = np.linalg.eig(T)
+    print("Eigenvalores de matriz T:\n"+str(l))
+    print("\n")
+    print("Eigenvectores de matriz T:\n"+str(v)) #Eigenvectores de matriz T
 
-#Nos interesa el eigenvector que corresponde con el eigenvalor 1, ya que ambos valores del eigenvector (-0.651,-0.759) tienen el mimso signo. 
-#En este caso el vector que esta como segunda columna en v. Lo extraemos y normalizamos:
-x_s = v[:,1] / sum(v[:,1])
-print(x_s)
+    #Nos interesa el eigenvector que corresponde con el eigenvalor 1, ya que ambos valores del eigenvector (-0.651,-0.759) tienen el mimso signo. 
+    #En este caso el vector que esta como segunda columna en v. Lo extraemos y normalizamos:
+    x_s = v[:,1] / sum(v[:,1])
+    print(x_s)
 
-#La matriz de probabilidad de estados es la misma que la obtenida con la iteración a 10 pasos de la función calcula_dist(T,x_0,n)
+    #La matriz de probabilidad de estados es la misma que la obtenida con la iteración a 10 pasos de la función calcula_dist(T,x_0,n)
+
+    #La clase MarkovChain hace lo mismo sin elegir la columna a mano, y también funciona con matrices dispersas de muchos estados
+    cm = MarkovChain(T)
+    print(cm.stationary())
+    #Evoluciona varias distribuciones iniciales a la vez, una por columna
+    print(cm.evolve(np.eye(2),10))
 
 """---
 
@@ -207,8 +381,8 @@ class MDP: #Classes son instancias de Python que actúan como constructores de o
         :param s: states
         :param r: rewards
         :param a: actions
-        :param T: dictionary where keys are (s,a) pairs and
-        values are probabilities
+        :param T: dictionary where keys are (s,t,a) triples and
+        values are the probabilities of moving from s to t with a
         :param gamma: the discount factor
         """
         self.s = s
@@ -217,97 +391,247 @@ class MDP: #Classes son instancias de Python que actúan como constructores de o
         self.T = T
         self.gamma = gamma
         
-    def policy_iteration(self,pi=None):
+    def policy_iteration(self,pi=None,verbose=False,max_iter=None,
+                         callback=None,profile=False):
         """
             Policy iteration algorithm
+        :param pi: initial policy, one action per state in the order of s
+        :param verbose: print the policy, T(pi) and V(s) of every iteration
+        :param max_iter: maximum number of improvement steps
+        :param callback: called with a record of every iteration, see
+        ConvergenceLog
+        :param profile: add evaluation_time and improvement_time to the
+        records
         """
         #initial random policy
         if not pi:
             pi = [choice(self.a) for s in self.s]
-        
-        print('pi = '+str(pi))
-        self.obtainT(pi);
-        T = self.obtainT(pi)
-        print('T(pi) = \n'+str(T))
-        
-        V = np.matmul(np.linalg.inv(np.eye(3)-self.gamma*T.T),self.r)
-        print('V(s) = '+ str(V))
-        
-        pi_star = self.find_pi_star(V)
-        print("pi*(s) = "+str(pi_star))
-        
-        if pi_star == pi:
-            return pi
-        else:
-            return self.policy_iteration(pi_star)
+        pi = list(pi)
+        self._arrays = self.transition_arrays()
+        try:
+            return self._policy_iteration(pi,verbose,max_iter,callback,
+                                          profile)
+        finally:
+            self._arrays = None
+
+    def _policy_iteration(self,pi,verbose,max_iter,callback,profile):
+        iteration = 0
+        V_prev = None
+        while True:
+            if callback is not None:
+                start = perf_counter()
+            if verbose:
+                print('pi = '+str(pi))
+            T = self.obtainT(pi)
+            if verbose:
+                print('T(pi) = \n'+str(T))
+            
+            # (I - gamma T(pi)^T) V = r, solved without forming the inverse
+            V = np.linalg.solve(np.eye(len(self.s))-self.gamma*T.T.A,
+                                np.asarray(self.r,dtype=float))
+            if verbose:
+                print('V(s) = '+ str(V))
+            if callback is not None:
+                evaluated = perf_counter()
+            
+            pi_star = self.find_pi_star(V,pi)
+            if verbose:
+                print("pi*(s) = "+str(pi_star))
+            
+            iteration += 1
+            if callback is not None:
+                end = perf_counter()
+                record = {'solver':'policy_iteration','iteration':iteration,
+                          'policy_changes':sum(a != b for a,b in zip(pi,pi_star)),
+                          'residual':None if V_prev is None else \
+                              float(np.abs(V-V_prev).max()),
+                          'time':end-start}
+                if profile:
+                    record['evaluation_time'] = evaluated-start
+                    record['improvement_time'] = end-evaluated
+                callback(record)
+                V_prev = V
+            if pi_star == pi or \
+                    (max_iter is not None and iteration >= max_iter):
+                self.stats = {'iterations':iteration}
+                return pi_star
+            pi = pi_star
+
+    def policy_iteration_batch(self,gammas=None,rewards=None,pi=None,
+                               max_iter=None):
+        """
+        Policy iteration of K variants of the problem at once, differing in
+        the discount factor and/or the rewards. The variants sharing the
+        discount factor and the current policy are evaluated by a single
+        solve with one right hand side each, and the action values of
+        every improvement are summed over the transitions, as
+        action_values does
+        :param gammas: K discount factors, self.gamma by default
+        :param rewards: (K,states) rewards, self.r by default
+        :param pi: initial policy shared by the variants, random by default
+        :param max_iter: maximum number of improvement steps
+        :return: (states,K) values and the K policies
+        """
+        gammas = np.atleast_1d(self.gamma if gammas is None else gammas)
+        rewards = np.atleast_2d(np.asarray(self.r if rewards is None \
+                                           else rewards,dtype=float))
+        K = np.broadcast_shapes(gammas.shape,rewards.shape[:1])[0]
+        gammas = np.broadcast_to(gammas,(K,)).astype(float)
+        rewards = np.broadcast_to(rewards,(K,len(self.s)))
+        n,n_a = len(self.s),len(self.a)
+        s,t,a,p = self.transition_arrays()
+        # (s,a) pair of every transition
+        pair = s*n_a+a
+        a_index = {x:i for i,x in enumerate(self.a)}
+        if not pi:
+            pi = [choice(self.a) for x in self.s]
+        pi = np.tile([a_index[x] for x in pi],(K,1))
+        V = np.zeros((K,n))
+        iterations = np.zeros(K,dtype=int)
+        # variants still improving
+        active = np.arange(K)
+        while len(active):
+            # (I - gamma T(pi)^T) V = r, once per distinct gamma and policy
+            keys = np.column_stack([gammas[active],pi[active]])
+            _,group = np.unique(keys,axis=0,return_inverse=True)
+            group = group.ravel()
+            for j in range(group.max()+1):
+                members = active[group == j]
+                k = members[0]
+                chosen = a == pi[k][s]
+                A = np.eye(n)
+                # a (s,t,a) key is unique, so is (s,t) for one action
+                A[s[chosen],t[chosen]] -= gammas[k]*p[chosen]
+                V[members] = np.linalg.solve(A,rewards[members].T).T
+            iterations[active] += 1
+            # Q[k,s,a], keeping the current action unless another is
+            # strictly better
+            k = len(active)
+            index = (np.arange(k)[:,None]*(n*n_a)+pair).ravel()
+            Q = np.bincount(index,weights=(p*V[active][:,t]).ravel(),
+                            minlength=k*n*n_a).reshape(k,n,n_a)
+            best = Q.argmax(axis=2)
+            current = np.take_along_axis(Q,pi[active][...,None],2)[...,0]
+            better = Q.max(axis=2) > current
+            stable = ~better.any(axis=1)
+            pi[active] = np.where(better,best,pi[active])
+            if max_iter is not None:
+                stable |= iterations[active] >= max_iter
+            active = active[~stable]
+        self.stats = {'iterations':iterations.tolist()}
+        return V.T,[[self.a[i] for i in row] for row in pi]
+    
+    def transition_arrays(self):
+        """
+        T as coordinate arrays of state index, next state index, action
+        index and probability, following the order of s and a. Keys missing
+        from T have probability 0. They are read from T on every call, so
+        editing T in place is seen by the next call, except during a
+        policy iteration, which reads T once when it starts.
+        """
+        if getattr(self,'_arrays',None) is not None:
+            return self._arrays
+        s_index = {s:i for i,s in enumerate(self.s)}
+        a_index = {a:i for i,a in enumerate(self.a)}
+        items = [(s_index[s],s_index[t],a_index[a],p) \
+                 for (s,t,a),p in self.T.items() if p]
+        s,t,a,p = zip(*items)
+        return (np.array(s,dtype=np.intp),np.array(t,dtype=np.intp),
+                np.array(a,dtype=np.intp),np.array(p,dtype=float))
         
     def obtainT(self,pi):
         """
         Obtains the transition probability matrix parametrized by the policy pi
         :param pi: the policy
         """
-        return           np.matrix([[self.T[(s,t,pi[s])] for s in self.s] for t in self.s])
+        s,t,a,p = self.transition_arrays()
+        a_index = {a:i for i,a in enumerate(self.a)}
+        pi = np.array([a_index[x] for x in pi])
+        chosen = a == pi[s]
+        T = np.zeros((len(self.s),len(self.s)))
+        # column s holds the distribution of the next state
+        T[t[chosen],s[chosen]] = p[chosen]
+        return np.matrix(T)
+    
+    def action_values(self,V):
+        """
+        Expected value of the next state for every state and action
+        :param V: the infinite horizon expected utility
+        :return: (states,actions) array
+        """
+        s,t,a,p = self.transition_arrays()
+        n_a = len(self.a)
+        return np.bincount(s*n_a+a,weights=p*np.asarray(V).ravel()[t],
+                           minlength=len(self.s)*n_a).reshape(-1,n_a)
         
-    def find_pi_star(self,V):
+    def find_pi_star(self,V,pi=None):
         """
         Finds the optimal policy for the given infinite horizon values
         :param V: the infinite horizon expected utility
+        :param pi: current policy, whose action is kept in a state unless
+        another one is strictly better
         """
-        
-        print("\n".join([str((x,np.matmul(self.obtainT(x).T,np.array(V).T))) for x in product(self.a,self.a,self.a)]))
-        
-        return list(max(product(self.a,self.a,self.a),            key=lambda x: np.sum(np.matmul(self.obtainT(x).T,np.array(V).T))))
-
-# Para ejecutar el algoritmo primero definimos los estados posibles:
-estados = [0,1,2]
-print(estados)
-
-# Las acciones posibles:
-acciones = [0,1]
-print(acciones)
-
-# Ahora las recompensas para cada estado:
-recompensas = [0,10,27]
-print(recompensas)
-
-# El parámetro gamma es el factor de descuento para la utilidad de valores futuros:
-gamma = 0.9
-print(gamma)
-
-
-# Ahora representamos las probabilidaddes condicionales con un diccionario.
-# <img src="mdpejemplo2.png" alt="mdp" width="914"/>
-
-# La llave será una tupla con tres elementos, los primeros dos contienen los índices de la transición de estado, el último es la acción que se toma.
+        Q = self.action_values(V)
+        best = Q.argmax(axis=1)
+        if pi is not None:
+            a_index = {a:i for i,a in enumerate(self.a)}
+            current = np.array([a_index[x] for x in pi])
+            keep = Q[np.arange(len(self.s)),current] >= \
+                Q[np.arange(len(self.s)),best]
+            best = np.where(keep,current,best)
+        return [self.a[i] for i in best]
+
+def demo_mdp():
+    # Para ejecutar el algoritmo primero definimos los estados posibles:
+    estados = [0,1,2]
+    print(estados)
+
+    # Las acciones posibles:
+    acciones = [0,1]
+    print(acciones)
+
+    # Ahora las recompensas para cada estado:
+    recompensas = [0,10,27]
+    print(recompensas)
+
+    # El parámetro gamma es el factor de descuento para la utilidad de valores futuros:
+    gamma = 0.9
+    print(gamma)
+
+
+    # Ahora representamos las probabilidaddes condicionales con un diccionario.
+    # <img src="mdpejemplo2.png" alt="mdp" width="914"/>
+
+    # La llave será una tupla con tres elementos, los primeros dos contienen los índices de la transición de estado, el último es la acción que se toma.
  
-# El valor del diccionario es la probabilidad asociada al estado, acción correspondiente.
+    # El valor del diccionario es la probabilidad asociada al estado, acción correspondiente.
 
-T={
-    (0,0,0):0.7,(0,0,1):0.5, (1,0,0):0.4,(1,0,1):0.2, (2,0,0):0.2,(2,0,1):0.1,
-    (0,1,0):0.1,(0,1,1):0.3, (1,1,0):0.4,(1,1,1):0.7, (2,1,0):0.2,(2,1,1):0.1,
-    (0,2,0):0.2,(0,2,1):0.2, (1,2,0):0.2,(1,2,1):0.1, (2,2,0):0.6,(2,2,1):0.8
-}
-print(T)
+    T={
+        (0,0,0):0.7,(0,0,1):0.5, (1,0,0):0.4,(1,0,1):0.2, (2,0,0):0.2,(2,0,1):0.1,
+        (0,1,0):0.1,(0,1,1):0.3, (1,1,0):0.4,(1,1,1):0.7, (2,1,0):0.2,(2,1,1):0.1,
+        (0,2,0):0.2,(0,2,1):0.2, (1,2,0):0.2,(1,2,1):0.1, (2,2,0):0.6,(2,2,1):0.8
+    }
+    print(T)
 
 
-# Vamos a crear una instancia del PDM:
-mdp = MDP(estados,recompensas,acciones,T,gamma)
+    # Vamos a crear una instancia del PDM:
+    mdp = MDP(estados,recompensas,acciones,T,gamma)
 
 
-# Comprobamos que obtenemos la misma política que el ejemplo del tren inteligente.
-# 
-# En el ejemplo $\pi_0 = \begin{bmatrix}0&0&0\end{bmatrix}$.
+    # Comprobamos que obtenemos la misma política que el ejemplo del tren inteligente.
+    # 
+    # En el ejemplo $\pi_0 = \begin{bmatrix}0&0&0\end{bmatrix}$.
 
 
-pi_0 = [0,0,0]
-print("T(pi_0) = \n"+str(mdp.obtainT(pi_0)))
+    pi_0 = [0,0,0]
+    print("T(pi_0) = \n"+str(mdp.obtainT(pi_0)))
 
 
-# Ahora invocamos el algoritmo de iteración de políticas.
-# 
-# El algoritmo imprime como cambia la política con las iteraciones.
+    # Ahora invocamos el algoritmo de iteración de políticas.
+    # 
+    # El algoritmo imprime como cambia la política con las iteraciones.
 
-politica = mdp.policy_iteration(pi_0)
+    politica = mdp.policy_iteration(pi_0,verbose=True)
 
 """---
 ---
@@ -329,22 +653,182 @@ politica = mdp.policy_iteration(pi_0)
 """
 
 import numpy as np
-import pylab as pl
-from IPython import display
-from itertools import product
+from itertools import islice,product
+from heapq import heapify,heappop,heappush
 from math import inf,sqrt
-from random import choice,choices
+from statistics import NormalDist
+from tempfile import TemporaryFile,mkstemp
+import hashlib
+import json
+import os
+from collections.abc import MutableMapping
+from types import MappingProxyType
+from time import perf_counter
 
 INACCESIBLE = 0
 ACCESIBLE = 1
 TERMINAL = 2
 
+def _pylab():
+    # matplotlib is only needed to draw, so it is imported on first use
+    import pylab
+    return pylab
+
+def _display(figure):
+    # shows the figure inline when running under IPython
+    try:
+        from IPython import display
+    except ImportError:
+        return
+    display.display(figure)
+
+class ConvergenceLog:
+    """
+    Solver callback keeping the records in memory as one column per field.
+    The solvers call it with flat dictionaries:
+
+    * compute_v, every sweep: sweep, residual (largest change of V),
+      policy_changes (of the greedy action), time, backups_per_s and,
+      with profile, backup_time and residual_time
+    * compute_optimal_pi, once: time and, with profile, extraction_time
+    * q_learn, every episode: episode, return (rewards of the visited
+      cells), length and terminated
+    * policy_iteration, every iteration: iteration, policy_changes,
+      residual, time and, with profile, evaluation_time and
+      improvement_time
+    """
+
+    def __init__(self):
+        self.columns = {}
+
+    def __call__(self,record):
+        columns = self.columns.setdefault(record['solver'],{})
+        n = len(next(iter(columns.values()),()))
+        for field,value in record.items():
+            if field != 'solver':
+                # fields missing from earlier records are None there
+                columns.setdefault(field,[None]*n).append(value)
+        for values in columns.values():
+            if len(values) == n:
+                values.append(None)
+
+    def arrays(self,solver):
+        """
+        :return: dictionary from field to numpy array, None becoming nan
+        """
+        return {field:np.array([np.nan if v is None else v for v in values]) \
+                for field,values in self.columns.get(solver,{}).items()}
+
+class JsonLinesLog:
+    """
+    Solver callback writing every record as a line of JSON
+    """
+
+    def __init__(self,file):
+        """
+        :param file: path or open text file
+        """
+        self._own = isinstance(file,(str,os.PathLike))
+        self.file = open(file,'w') if self._own else file
+
+    def __call__(self,record):
+        self.file.write(json.dumps(record,default=float)+'\n')
+
+    def close(self):
+        if self._own:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+class Renderer:
+    """
+    Redraw policy of the Map animations: a frame is drawn at most every
+    `every` calls and, with fps, at most fps times a second, with no
+    sleep unless a delay is asked for. The artists that change are
+    redrawn over a saved background (blitting) when the canvas supports
+    it, the whole figure otherwise.
+    """
+
+    def __init__(self,every=1,fps=None,delay=0):
+        """
+        :param every: draw one of every `every` frames
+        :param fps: maximum frames per second
+        :param delay: seconds to pause after a frame, 0 for none
+        """
+        self.every = every
+        self.fps = fps
+        self.delay = delay
+        self.start(None)
+
+    def start(self,figure):
+        # a new figure: its first frame is always drawn
+        self.figure = figure
+        self.background = None
+        self.calls = 0
+        self.last = -inf
+        self.frames = 0
+
+    def due(self):
+        """
+        Counts a frame and tells whether it is to be drawn
+        """
+        self.calls += 1
+        if (self.calls-1)%self.every:
+            return False
+        return self.fps is None or perf_counter()-self.last >= 1/self.fps
+
+    def draw(self,artists=(),full=False):
+        """
+        Draws the frame
+        :param artists: the animated artists, redrawn over the background
+        :param full: redraw everything, e.g. after a colorbar change
+        """
+        canvas = self.figure.canvas
+        if artists and getattr(canvas,'supports_blit',False):
+            if full or self.background is None:
+                # the background without the artists, which stay visible
+                # for later full draws
+                for artist in artists:
+                    artist.set_visible(False)
+                canvas.draw()
+                self.background = canvas.copy_from_bbox(self.figure.bbox)
+                for artist in artists:
+                    artist.set_visible(True)
+            canvas.restore_region(self.background)
+            for artist in artists:
+                self.figure.draw_artist(artist)
+            canvas.blit(self.figure.bbox)
+        else:
+            canvas.draw_idle()
+        if self.delay:
+            _pylab().pause(self.delay)
+        else:
+            canvas.flush_events()
+        self.last = perf_counter()
+        self.frames += 1
+
+def _frozen_matrix(a):
+    # read-only matrix of the map or of an action, copied unless already
+    # read-only (the memory mapped arrays of compiled worlds) so that no
+    # alias of the caller can change it behind the cached models
+    a = np.asmatrix(a)
+    if a.flags.writeable:
+        a = a.copy()
+        a.flags.writeable = False
+    return a
+
 class Map:
     
     def __init__(self,types,rewards):
-        self.types = np.matrix(types)
-        self.rewards = np.matrix(rewards)
-        self.rows,self.cols = self.types.shape 
+        # bumped on every assignment of types or of rewards, so cached
+        # structures derived from the map know when to rebuild
+        self.types_version = self.rewards_version = 0
+        self.types = types
+        self.rewards = rewards
         #padding for plots
         self.e = 0.04
         x = 1/sqrt(2)
@@ -358,8 +842,35 @@ class Map:
                        'W':(-1,0),
                        'NW':(-x,x)}
 
-        self.point = None
+        # figure, artists and renderer of the running animations
+        self._vs_plot = None
+        self._move_plot = None
         
+    def __setstate__(self,state):
+        # unpickled arrays come back writeable
+        state['_types'] = _frozen_matrix(state['_types'])
+        state['_rewards'] = _frozen_matrix(state['_rewards'])
+        self.__dict__.update(state)
+
+    @property
+    def types(self):
+        return self._types
+
+    @types.setter
+    def types(self,types):
+        self._types = _frozen_matrix(types)
+        self.rows,self.cols = self._types.shape
+        self.types_version += 1
+
+    @property
+    def rewards(self):
+        return self._rewards
+
+    @rewards.setter
+    def rewards(self,rewards):
+        self._rewards = _frozen_matrix(rewards)
+        self.rewards_version += 1
+
     def __str__(self):
         return 'types: '+'\n'+str(self.types)+'\n'+\
                 'rewards: '+'\n'+str(self.rewards)
@@ -367,25 +878,33 @@ class Map:
     def __repr__(self):
         return str(self)
     
+    def _draw_cells(self,ax):
+        # one square per cell coloured by type, as a single collection so
+        # that big maps draw fast
+        from matplotlib.collections import PolyCollection
+        e = self.e
+        i,j = np.mgrid[0:self.rows,0:self.cols]
+        corners = np.array([[0,0],[0,1],[1,1],[1,0]])
+        origins = np.stack([j.ravel(),i.ravel()],axis=1)*(1+e)
+        colors = np.array(['black','green','red'])[np.asarray(self.types)]
+        ax.add_collection(PolyCollection(origins[:,None,:]+corners,
+                                         facecolors=colors.ravel(),
+                                         linewidths=0))
+        ax.autoscale_view()
+
     def display_map(self):
+        pl = _pylab()
         pl.figure()
         ax = pl.gca()
         ax.axis("equal")
-        xcoor = [0,0,1,1,0]
-        ycoor = [0,1,1,0,0]
-        colors = ['black','green','red']
-        e = self.e
-        for i in range(self.rows):
-            r = [x+(i*(e+1)) for x in xcoor]
-            for j in range(self.cols):
-                c = [y+(j*(e+1)) for y in ycoor]
-                pl.fill(c,r,colors[self.types[i,j]])
+        self._draw_cells(ax)
         #check this on jupyter notebooks
         #display.display(pl.gcf())
         pl.axis('off')
         pl.title('Agent environment')
         
     def display_rewards(self):
+        pl = _pylab()
         pl.figure()
         cmap = pl.cm.bwr
         cmap.set_bad(color='black')
@@ -395,25 +914,50 @@ class Map:
         pl.axis('off')
         pl.title('Reward signal')
         
-    def animate_Vs(self,V, error, reset=False, delay=0.5):
-        if reset:
-            pl.figure()
+    def animate_Vs(self,V,error,reset=False,renderer=None,force=False):
+        """
+        Draws the value function. The image and its colorbar are created
+        on reset and later frames only update their data, on the calls the
+        renderer lets through.
+        :param V: {(x,y):v} dictionary or flat array of the values
+        :param error: residual shown in the title
+        :param renderer: Renderer of the animation, kept from the reset;
+        at most 10 frames a second by default, Renderer(every=1) draws all
+        :param force: draw this frame whatever the renderer says, e.g.
+        the last one
+        """
+        pl = _pylab()
+        if reset or self._vs_plot is None:
+            renderer = renderer or Renderer(fps=10)
+            renderer.start(pl.figure())
+            cmap = pl.cm.bwr
+            cmap.set_bad(color='black')
+            image = pl.imshow(self._values_image(V),cmap=cmap,origin='lower')
+            pl.axis('off')
+            title = pl.title('')
+            self._vs_plot = (image,title,pl.colorbar(),renderer)
+            force = True
+        image,title,colorbar,renderer = self._vs_plot
+        if not (renderer.due() or force):
+            return
+        image.set_data(self._values_image(V))
+        clim = image.get_clim()
+        image.autoscale()
+        title.set_text('Infinite horizon value function. Error = %f'%error)
+        # the colorbar only needs a redraw when the scale moves
+        renderer.draw([image,title],full=image.get_clim() != clim)
+
+    def _values_image(self,V):
+        if isinstance(V,dict):
+            vs = self.rewards.copy()
+            for (x,y),v in V.items():
+                vs[y,x] = v
         else:
-            self.cb.remove()
-        cmap = pl.cm.bwr
-        cmap.set_bad(color='black')
-        vs= self.rewards.copy()
-        for (x,y),v in V.items():
-            vs[y,x]=v
-        r = np.ma.masked_where(self.rewards==0.0,vs)
-        pl.imshow(r,cmap=cmap,origin='lower')
-        pl.axis('off')
-        pl.title('Infinite horizon value function. Error = %f'%error)  
-        self.cb = pl.colorbar()
-        pl.pause(delay)
+            vs = np.reshape(V,(self.rows,self.cols))
+        return np.ma.masked_where(self.rewards==0.0,vs)
 
-        
     def display_probs(self,probs):
+        pl = _pylab()
         pl.figure()
         vbar = np.ones((3,1))
         hbar = np.ones((1,11))
@@ -436,37 +980,58 @@ class Map:
         self.display_rewards()
         self.display_probs(probs)
         
-    def animate_move(self,x_prev,x,reset=False,cumreward=None,delay=1):
+    def animate_move(self,x_prev,x,reset=False,cumreward=None,
+                     renderer=None,force=False):
+        """
+        Draws a move of the agent from x_prev to x. The map is drawn on
+        reset; later frames only update the trajectory, the agent and the
+        title, on the calls the renderer lets through.
+        :param renderer: Renderer of the animation, kept from the reset;
+        at most 10 moves a second by default, Renderer(every=1) draws all
+        :param force: draw this frame whatever the renderer says
+        """
+        pl = _pylab()
         #padding
         e = self.e
-        if reset:
-            pl.figure()
-            self.point = False
+        if reset or self._move_plot is None:
+            renderer = renderer or Renderer(fps=10)
+            renderer.start(pl.figure())
             ax = pl.gca()
             ax.axis("equal")
-            xcoor = [0,0,1,1,0]
-            ycoor = [0,1,1,0,0]
-            colors = ['black','green','red']
-            for i in range(self.rows):
-                r = [x+(i*(e+1)) for x in xcoor]
-                for j in range(self.cols):
-                    c = [y+(j*(e+1)) for y in ycoor]
-                    pl.fill(c,r,colors[self.types[i,j]])
-            display.display(pl.gcf())
+            self._draw_cells(ax)
+            trail, = pl.plot([],[],color='white')
+            point, = pl.plot([],[],marker='.',c='cyan',markersize=40)
+            title = pl.title('')
+            self._move_plot = ([],[],trail,point,title,renderer)
+            _display(pl.gcf())
+            force = True
+        xs,ys,trail,point,title,renderer = self._move_plot
         x_prev = list(map(lambda c:c+0.5+e*c,x_prev))
         x = list(map(lambda c:c+0.5+e*c,x))
-        pl.plot(*zip(x_prev,x),color='white')
-        if self.point:
-            ax = pl.gca()
-            ax.lines[-2].remove()
-        else:
-            self.point = True
-        pl.plot([x[0],x[0]],[x[1],x[1]],marker='.',c='cyan',markersize=40)    
+        if not xs or (xs[-1],ys[-1]) != tuple(x_prev):
+            xs.append(x_prev[0])
+            ys.append(x_prev[1])
+        xs.append(x[0])
+        ys.append(x[1])
+        if not (renderer.due() or force):
+            return
+        trail.set_data(xs,ys)
+        point.set_data([x[0]],[x[1]])
         if cumreward:
-            pl.title("Cummulative reward: "+f'{cumreward:06.2f}')
-        pl.pause(delay)
-        
-    def show_policy(self,pi):
+            title.set_text("Cummulative reward: "+f'{cumreward:06.2f}')
+        renderer.draw([trail,point,title])
+
+    def show_policy(self,pi,actions=None):
+        """
+        :param pi: {(x,y):action} policy or flat array of action indices
+        :param actions: action names of the indices, those of the arrows
+        by default
+        """
+        if isinstance(pi,np.ndarray):
+            names = list(actions or self.arrows)
+            pi = {(s%self.cols,s//self.cols):names[a] \
+                  for s,a in enumerate(pi.tolist()) if a >= 0}
+        pl = _pylab()
         e = 2*self.e
         pl.figure()
         ax = pl.gca()
@@ -480,8 +1045,7 @@ class Map:
                 c = [y+(j*(2*e+1)) for y in ycoor]
                 pl.plot(c,r,colors[self.types[i,j]])
                 if self.types[(i,j)]== ACCESIBLE:
-                    ar
-                    row = self.arrows[pi[(j,i)]]
+                    arrow = self.arrows[pi[(j,i)]]
                     ax.quiver(
                             j*(2*e+1)+0.5,
                             i*(2*e+1)+0.5,
@@ -490,32 +1054,1020 @@ class Map:
                             scale=2,
                             scale_units='x')
         pl.show()
-        display.display(pl.gcf())
+        _display(pl.gcf())
+
+def alias_table(p):
+    """
+    Walker alias table of a discrete distribution (Vose's construction).
+    Outcome i=int(u*n) is kept if the fraction u*n-i is below prob[i] and
+    replaced by alias[i] otherwise.
+    :param p: probabilities of the n outcomes
+    :return: prob and alias arrays
+    """
+    p = np.asarray(p,dtype=float)
+    n = len(p)
+    scaled = p*n/p.sum()
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        l,g = small.pop(),large.pop()
+        prob[l] = scaled[l]
+        alias[l] = g
+        scaled[g] += scaled[l]-1
+        (small if scaled[g] < 1 else large).append(g)
+    # leftovers are 1 up to rounding
+    return prob,alias
+
+class RandomStream:
+    """
+    Uniform draws in [0,1) from a seedable numpy Generator. Scalars are
+    drawn in blocks and handed out one at a time.
+    """
+
+    def __init__(self,seed=None,block=65536):
+        self.generator = np.random.default_rng(seed)
+        self.block = block
+        self._buffer = []
+        self._pos = 0
+
+    def random(self):
+        if self._pos == len(self._buffer):
+            self._buffer = self.generator.random(self.block).tolist()
+            self._pos = 0
+        u = self._buffer[self._pos]
+        self._pos += 1
+        return u
+
+    def randrange(self,n):
+        return int(self.random()*n)
+
+    def take(self,size):
+        # array of draws, straight from the generator
+        return self.generator.random(size)
+
+class TransitionModel:
+    """
+    Compiled transition structure of a grid world.
+
+    Moves only reach the 3x3 neighbourhood, so the model is kept in two
+    equivalent forms over the flat row-major cell index:
+
+    * a stencil, targets[k,s] being the cell reached from s by the k-th
+      displacement of product([-1,0,1],[-1,0,1]) (s itself when the move
+      is rejected) and kernels[a,k] its probability under action a. The
+      batched solvers use it, one (n_actions,9)x(9,n) product per sweep,
+      and so do the samplers, drawing k from the alias table of action a
+      (alias_prob[a],alias_index[a]).
+    * a CSR table with one row per (action,state) pair, row a*n+s, holding
+      the distinct successors of s under a in indices[indptr[r]:indptr[r+1]]
+      with probabilities probs[...]. The rows of action a start at entry
+      action_offsets[a]. It is built by compile_csr on first use, since a
+      sweep over the grid does not need it.
+
+    The reverse index, the accesible cells that can reach each cell, is
+    built by predecessors on first use too.
+    """
+
+    def __init__(self,types,kernels,targets=None):
+        """
+        :param types: (rows,cols) array of cell types
+        :param kernels: (n_actions,9) displacement probabilities
+        :param targets: stencil already compiled for these types, used
+        without copying
+        """
+        types = np.asarray(types)
+        self.rows,self.cols = types.shape
+        self.n_states = types.size
+        self.kernels = np.asarray(kernels,dtype=float)
+        self.n_actions = len(self.kernels)
+        self.types = types.ravel()
+        self.accesible = self.types == ACCESIBLE
+        self.terminal = self.types == TERMINAL
+        self.targets = self._compile_targets() if targets is None else targets
+        tables = [alias_table(kernel) for kernel in self.kernels]
+        self.alias_prob = np.array([p for p,_ in tables])
+        self.alias_index = np.array([a for _,a in tables])
+        # list copies for the scalar path of sample
+        self._alias = [list(zip(p.tolist(),a.tolist())) for p,a in tables]
+        self._csr = False
+        self._predecessors = None
+
+    def _compile_targets(self):
+        rows,cols = self.rows,self.cols
+        idx = np.arange(self.n_states)
+        y,x = np.divmod(idx,cols)
+        blocked = self.types == INACCESIBLE
+        targets = np.empty((9,self.n_states),dtype=np.intp)
+        for k,(dx,dy) in enumerate(product([-1,0,1],[-1,0,1])):
+            nx,ny = x+dx,y+dy
+            inside = (0<=nx)&(nx<cols)&(0<=ny)&(ny<rows)
+            t = np.where(inside,ny*cols+nx,idx)
+            targets[k] = np.where(blocked[t],idx,t)
+        return targets
+
+    def compile_csr(self):
+        # builds indices, probs, indptr and action_offsets
+        if self._csr:
+            return
+        n = self.n_states
+        idx = np.arange(n)
+        stay = self.targets == idx
+        # index dtype wide enough for the grid, compact otherwise
+        itype = np.int32 if n < 2**31 else np.int64
+        indices,probs,counts = [],[],[]
+        for kernel in self.kernels:
+            # every rejected move is merged into the (0,0) displacement
+            p = np.where(stay,0.0,kernel[:,None])
+            p[4] = kernel @ stay
+            keep = (p > 0).T
+            indices.append(self.targets.T[keep].astype(itype))
+            probs.append(p.T[keep])
+            counts.append(keep.sum(axis=1))
+        self.indices = np.concatenate(indices)
+        self.probs = np.concatenate(probs)
+        self.indptr = np.zeros(self.n_actions*n+1,dtype=np.int64)
+        np.cumsum(np.concatenate(counts),out=self.indptr[1:])
+        self.action_offsets = self.indptr[::n]
+        self._csr = True
+
+    def predecessors(self):
+        """
+        Reverse index of the moves: the accesible cells that reach cell t
+        with positive probability under some action, t itself included when
+        it can stay, are pred_index[pred_ptr[t]:pred_ptr[t+1]]
+        :return: pred_ptr,pred_index
+        """
+        if self._predecessors is None:
+            n = self.n_states
+            cells = np.flatnonzero(self.accesible)
+            used = self.kernels.any(axis=0)
+            # (t,s) pairs sorted by t, the stays of s appearing only once
+            pairs = np.unique((self.targets[used][:,cells]*n+cells).ravel())
+            t,s = np.divmod(pairs,n)
+            pred_ptr = np.zeros(n+1,dtype=np.intp)
+            np.cumsum(np.bincount(t,minlength=n),out=pred_ptr[1:])
+            self._predecessors = pred_ptr,s
+        return self._predecessors
+
+    def successors(self,s,a):
+        """
+        Successor states of s under action a and their probabilities,
+        as views into the CSR arrays
+        :param s: flat state index
+        :param a: action index
+        """
+        self.compile_csr()
+        r = a*self.n_states+s
+        lo,hi = self.indptr[r],self.indptr[r+1]
+        return self.indices[lo:hi],self.probs[lo:hi]
+
+    def sample(self,s,a,u):
+        """
+        Successor of s under action a for the uniform draw u
+        """
+        u = u*9
+        i = int(u)
+        p,alias = self._alias[a][i]
+        return int(self.targets[i if u-i < p else alias,s])
+
+    def sample_batch(self,s,a,u):
+        """
+        Successors of many (state,action) pairs at once
+        :param s: flat state indices
+        :param a: action indices
+        :param u: uniform draws in [0,1), one per pair
+        :return: flat indices of the next states
+        """
+        # displacement drawn from the alias table of the action, then
+        # looked up in the stencil, which already sends rejected moves to s
+        u = np.asarray(u)*9
+        i = u.astype(np.intp)
+        k = np.where(u-i < self.alias_prob[a,i],i,self.alias_index[a,i])
+        return self.targets[k,s]
+
+    def action_values(self,V):
+        """
+        Expected value of the next state for every action and state
+        :param V: flat value array
+        :return: (n_actions,n_states) array
+        """
+        return self.kernels @ V[self.targets]
+
+class QTable(MutableMapping):
+    """
+    Q(s,a) stored as a dense (n_states,n_actions) float array over the
+    flat row-major cell index, with action names mapped to their position
+    in actions. As a mapping it behaves like the {((x,y),action):q} dict
+    q_learn used to build, restricted to the given states.
+    """
+
+    def __init__(self,cols,actions,states,values):
+        """
+        :param cols: columns of the grid, to turn (x,y) into a flat index
+        :param actions: action names, in column order
+        :param states: flat indices of the states that are keys
+        :param values: (n_states,n_actions) array, used without copying
+        """
+        self.cols = cols
+        self.actions = actions
+        self.action_index = {a:i for i,a in enumerate(actions)}
+        states = np.asarray(states)
+        # keys in the (x,y) order of product(range(cols),range(rows))
+        self.states = states[np.lexsort((states//cols,states%cols))]
+        self.values = values
+        self._valid = np.zeros(len(values),dtype=bool)
+        self._valid[self.states] = True
+
+    def _key(self,key):
+        (x,y),a = key
+        s = y*self.cols+x
+        if not (0<=x<self.cols and 0<=s<len(self.values) and self._valid[s]) \
+                or a not in self.action_index:
+            raise KeyError(key)
+        return s,self.action_index[a]
+
+    def __getitem__(self,key):
+        return self.values[self._key(key)]
+
+    def __setitem__(self,key,q):
+        self.values[self._key(key)] = q
+
+    def __delitem__(self,key):
+        raise TypeError('QTable entries can not be removed')
+
+    def __contains__(self,key):
+        try:
+            self._key(key)
+        except (KeyError,TypeError,ValueError):
+            return False
+        return True
+
+    def __iter__(self):
+        cols = self.cols
+        for s in self.states:
+            cell = (int(s)%cols,int(s)//cols)
+            for a in self.actions:
+                yield (cell,a)
+
+    def __len__(self):
+        return len(self.states)*len(self.actions)
+
+    def row(self,cell):
+        # view of the action values of a (x,y) cell
+        return self.values[cell[1]*self.cols+cell[0]]
+
+    def best_actions(self):
+        # index of the first maximizing action of every state
+        return self.values.argmax(axis=1)
+
+    def policy(self):
+        """
+        Greedy policy as a {(x,y):action} dict over the key states
+        """
+        best = self.best_actions()
+        cols = self.cols
+        return {(int(s)%cols,int(s)//cols):self.actions[best[s]] \
+                for s in self.states}
+
+class VectorEnv:
+    """
+    N independent agents stepped together on one MDPWorld. States are
+    flat cell indices and actions are indices into world.actions.
+    """
+
+    def __init__(self,world,n):
+        self.world = world
+        self.n = n
+        self.states = np.zeros(n,dtype=np.intp)
+        self.done = np.ones(n,dtype=bool)
+
+    def reset(self,states=None):
+        """
+        :param states: start cells, by default uniformly drawn among the
+        accesible cells
+        :return: the start states
+        """
+        if states is None:
+            cells = np.flatnonzero(self.world.model.accesible)
+            states = self.world.rng.generator.choice(cells,size=self.n)
+        self.states = np.array(np.broadcast_to(states,(self.n,)),
+                               dtype=np.intp)
+        self.done = self.world.model.terminal[self.states]
+        return self.states
+
+    def step(self,actions):
+        """
+        Moves every agent that has not reached a terminal cell; finished
+        agents stay where they are and get no reward
+        :param actions: action index per agent
+        :return: next states, rewards and terminal flags
+        """
+        s_p,rewards,terminal = self.world.move_batch(self.states,actions)
+        active = ~self.done
+        self.states = np.where(active,s_p,self.states)
+        rewards = np.where(active,rewards,0.0)
+        self.done = self.done|terminal
+        return self.states,rewards,self.done
+
+class ReplayBuffer:
+    """
+    Ring buffer of (s,a,r,s') transitions in flat arrays, the oldest
+    overwritten once capacity is reached
+    """
+
+    def __init__(self,capacity):
+        self.capacity = capacity
+        self.states = np.zeros(capacity,dtype=np.intp)
+        self.actions = np.zeros(capacity,dtype=np.int8)
+        self.rewards = np.zeros(capacity)
+        self.next_states = np.zeros(capacity,dtype=np.intp)
+        self.size = 0
+        self._pos = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self,states,actions,rewards,next_states):
+        """
+        Appends a batch of transitions, one per array entry
+        """
+        n = len(states)
+        index = (self._pos+np.arange(n))%self.capacity
+        self.states[index] = states
+        self.actions[index] = actions
+        self.rewards[index] = rewards
+        self.next_states[index] = next_states
+        self._pos = (self._pos+n)%self.capacity
+        self.size = min(self.size+n,self.capacity)
+
+    def sample(self,n,generator):
+        """
+        :return: s, a, r and s' arrays of n transitions drawn uniformly
+        with replacement
+        """
+        index = generator.integers(self.size,size=n)
+        return (self.states[index],self.actions[index],self.rewards[index],
+                self.next_states[index])
+
+# compiled worlds: MAGIC, header length (uint32), JSON header, then the
+# types, rewards and probs arrays at the 64 byte aligned offsets it lists
+COMPILED_SUFFIX = 'c'
+COMPILED_MAGIC = b'MDPC\x01'
+
+def world_hash(types,rewards,probs):
+    """
+    SHA-256 of the contents of a world, independent of how it was loaded
+    :param types: (rows,cols) cell types
+    :param rewards: (rows,cols) rewards
+    :param probs: (n_actions,3,3) move probabilities
+    """
+    h = hashlib.sha256()
+    for a,dtype in ((types,'<i1'),(rewards,'<f8'),(probs,'<f8')):
+        a = np.asarray(a)
+        h.update(str(a.shape).encode())
+        # in row blocks, memory-mapped worlds may not fit in memory
+        for r in range(0,len(a),4096):
+            h.update(np.ascontiguousarray(a[r:r+4096],dtype=dtype).tobytes())
+    return h.hexdigest()
+
+def _column_reduce(reduce,a):
+    # reduce (np.max, np.min) over the rows of a C-contiguous (m,k) array,
+    # 32 rows at a time: numpy is slow along the rows of narrow arrays
+    m,k = a.shape
+    head = m-m%32
+    parts = [a[head:]]
+    if head:
+        parts.append(reduce(a[:head].reshape(-1,32*k),axis=0).reshape(32,k))
+    return reduce(np.concatenate(parts),axis=0)
+
+def _stencil_windows(h,cols):
+    # slices of the rows padded by one cell on every side reached by each
+    # displacement, in the order of the kernels
+    for dx,dy in product([-1,0,1],[-1,0,1]):
+        yield slice(1+dy,1+dy+h),slice(1+dx,1+dx+cols)
+
+def stay_probs(types,kernels):
+    """
+    Probability of staying in place for every action and cell of a strip,
+    the sum of its blocked displacements; it only depends on the types,
+    so solvers sweeping the same strip keep it for backup_rows
+    :param types: (h+2,cols) types of the strip with its halo rows, as in
+    backup_rows
+    :param kernels: (n_actions,9) displacement probabilities
+    :return: (n_actions,h*cols) probabilities
+    """
+    h,cols = len(types)-2,types.shape[1]
+    # a column of blocked cells on either side
+    blocked = np.ones((h+2,cols+2))
+    blocked[:,1:-1] = types == INACCESIBLE
+    B = np.empty((9,h,cols))
+    for k,window in enumerate(_stencil_windows(h,cols)):
+        B[k] = blocked[window]
+    return kernels @ B.reshape(9,-1)
+
+def backup_rows(V,types,R,kernels,gamma,stay=None):
+    """
+    Bellman backup of a strip of whole rows of the grid, straight from the
+    3x3 stencil: no targets table, only the strip and a halo row above and
+    below it are read
+    :param V: (h+2,cols) values of the strip with its halo rows
+    :param types: (h+2,cols) types of the same rows, INACCESIBLE for the
+    halo rows outside the grid
+    :param R: (h,cols) rewards of the strip
+    :param kernels: (n_actions,9) displacement probabilities
+    :param gamma: the discount factor
+    :param stay: stay_probs of the strip, computed if not given
+    :return: (h,cols) float64 values, backed up in the accesible cells
+    and as in V elsewhere
+    """
+    h,cols = R.shape
+    if stay is None:
+        stay = stay_probs(types,kernels)
+    # blocked moves count through stay, so they reach a 0 here
+    Vz = np.zeros((h+2,cols+2))
+    Vz[:,1:-1] = np.where(types == INACCESIBLE,0.0,V)
+    D = np.empty((9,h,cols))
+    for k,window in enumerate(_stencil_windows(h,cols)):
+        D[k] = Vz[window]
+    Q = kernels @ D.reshape(9,-1)
+    Q += stay*V[1:-1].reshape(1,-1)
+    backed_up = R+gamma*Q.max(axis=0).reshape(h,cols)
+    return np.where(types[1:-1] == ACCESIBLE,backed_up,V[1:-1])
+
+def _parse_error(filename,line,message):
+    return ValueError('%s:%d: %s'%(filename,line,message))
+
+def _parse_map_rows(filename,lines,first,cols,dtype):
+    """
+    Parses consecutive map rows into (types,rewards), the first of them
+    being line number first of the file
+    """
+    try:
+        values = np.loadtxt(lines,dtype=np.float64,ndmin=2)
+    except ValueError:
+        values = None
+    if values is None or values.size != 2*cols*len(lines):
+        # find the offending row
+        for n,line in enumerate(lines,first):
+            tokens = line.split()
+            if len(tokens) != 2*cols:
+                raise _parse_error(filename,n,'expected %d values (type and '
+                                   'reward of %d cells), found %d'
+                                   %(2*cols,cols,len(tokens)))
+            try:
+                np.loadtxt([line],dtype=np.float64)
+            except ValueError:
+                raise _parse_error(filename,n,'non numeric value in '+
+                                   repr(line.strip())) from None
+        raise _parse_error(filename,first,'malformed rows %d to %d'
+                           %(first,first+len(lines)-1))
+    values = values.reshape(len(lines),2*cols)
+    types = values[:,0::2]
+    bad = (types != np.round(types))|(types < INACCESIBLE)|(types > TERMINAL)
+    if bad.any():
+        row,col = map(int,np.argwhere(bad)[0])
+        raise _parse_error(filename,first+row,'invalid cell type %g in '
+                           'column %d'%(types[row,col],col))
+    return types.astype(np.int8),values[:,1::2].astype(dtype)
+
+def parse_mdp(filename,n_actions=8,dtype=np.float64,chunk_values=1<<18):
+    """
+    Streams a text .mdp file into preallocated arrays, parsing about
+    chunk_values numbers at a time, so memory stays close to the size of
+    the result
+    :param n_actions: number of 3x3 probability blocks after the map
+    :param dtype: dtype of the rewards
+    :return: types (int8), rewards and probs as (rows,cols), (rows,cols)
+    and (n_actions,3,3) arrays
+    :raises ValueError: with the line number of a malformed line
+    """
+    with open(filename) as f:
+        header = f.readline().split()
+        try:
+            rows,cols = map(int,header)
+        except ValueError:
+            raise _parse_error(filename,1,'expected "rows cols", found '+
+                               repr(' '.join(header))) from None
+        if rows <= 0 or cols <= 0:
+            raise _parse_error(filename,1,'invalid map size %dx%d'%(rows,cols))
+        types = np.empty((rows,cols),dtype=np.int8)
+        rewards = np.empty((rows,cols),dtype=dtype)
+        chunk_rows = max(1,chunk_values//(2*cols))
+        row = 0
+        while row < rows:
+            lines = list(islice(f,min(chunk_rows,rows-row)))
+            if not lines:
+                raise _parse_error(filename,row+2,'expected %d map rows, '
+                                   'found %d'%(rows,row))
+            t,r = _parse_map_rows(filename,lines,row+2,cols,dtype)
+            types[row:row+len(lines)] = t
+            rewards[row:row+len(lines)] = r
+            row += len(lines)
+        probs = np.empty((n_actions,3,3))
+        for n in range(3*n_actions):
+            line = f.readline()
+            number = rows+2+n
+            try:
+                values = [float(v) for v in line.split()]
+            except ValueError:
+                values = None
+            if not line:
+                raise _parse_error(filename,number,'expected %d probability '
+                                   'rows, found %d'%(3*n_actions,n))
+            if values is None or len(values) != 3:
+                raise _parse_error(filename,number,'expected 3 probabilities,'
+                                   ' found '+repr(line.strip()))
+            probs[n//3,n%3] = values
+    return types,rewards,probs
+
+def compiled_path(filename):
+    return filename+COMPILED_SUFFIX
+
+def compile_mdp(filename,output=None):
+    """
+    Converts a text .mdp file to the binary format MDPWorld maps from
+    disk, next to the source by default
+    :param filename: the text .mdp file
+    :param output: path of the compiled file
+    :return: path of the compiled file
+    """
+    output = output or compiled_path(filename)
+    world = MDPWorld()
+    world.read_text(filename)
+    stat = os.stat(filename)
+    return write_compiled(output,world.map.types,world.map.rewards,
+                          [world.probs[a] for a in world.actions],
+                          world.actions,
+                          {'size':stat.st_size,'mtime_ns':stat.st_mtime_ns})
+
+def write_compiled(output,types,rewards,probs,actions,source=None,
+                   rows_per_write=4096):
+    """
+    Writes a world in the compiled format, row blocks at a time so that
+    memory-mapped inputs larger than RAM can be written too
+    :param types: (rows,cols) cell types, stored as int8
+    :param rewards: (rows,cols) rewards, float32 or float64
+    :param probs: 3x3 move probabilities of every action
+    :param actions: action names, in the order of probs
+    :param source: size and mtime_ns of the text file it comes from
+    :return: output
+    """
+    types = np.asarray(types)
+    rewards = np.asarray(rewards)
+    if rewards.dtype not in (np.float32,np.float64):
+        rewards = rewards.astype(np.float64)
+    probs = np.array(probs,dtype=np.float64)
+    header = {'rows':int(types.shape[0]),'cols':int(types.shape[1]),
+              'actions':list(actions),
+              'source':source,
+              'hash':world_hash(types,rewards,probs),
+              'arrays':{}}
+    arrays = {'types':(types,np.dtype(np.int8)),
+              'rewards':(rewards,rewards.dtype),'probs':(probs,probs.dtype)}
+    # the header length depends on the offsets, so lay out after a
+    # generous fixed block for it
+    offset = 4096
+    for name,(a,dtype) in arrays.items():
+        header['arrays'][name] = {'offset':offset,'dtype':dtype.str,
+                                  'shape':list(a.shape)}
+        offset = -(-(offset+a.size*dtype.itemsize)//64)*64
+    raw = json.dumps(header).encode()
+    if len(COMPILED_MAGIC)+4+len(raw) > 4096:
+        raise ValueError('compiled header too long')
+    tmp = output+'.tmp'
+    with open(tmp,'wb') as f:
+        f.write(COMPILED_MAGIC)
+        f.write(np.uint32(len(raw)).tobytes())
+        f.write(raw)
+        for name,(a,dtype) in arrays.items():
+            f.seek(header['arrays'][name]['offset'])
+            for r in range(0,len(a),rows_per_write):
+                f.write(a[r:r+rows_per_write].astype(dtype).tobytes())
+    os.replace(tmp,output)
+    return output
+
+def read_compiled_header(path):
+    with open(path,'rb') as f:
+        if f.read(len(COMPILED_MAGIC)) != COMPILED_MAGIC:
+            raise ValueError(path+' is not a compiled .mdp file')
+        n = int(np.frombuffer(f.read(4),dtype=np.uint32)[0])
+        return json.loads(f.read(n).decode())
+
+def compiled_is_fresh(filename,path=None):
+    """
+    Whether a compiled file exists and was built from the current
+    version (size and modification time) of the text file
+    """
+    path = path or compiled_path(filename)
+    try:
+        header = read_compiled_header(path)
+        stat = os.stat(filename)
+    except (OSError,ValueError):
+        return False
+    return header['source'] == {'size':stat.st_size,
+                                'mtime_ns':stat.st_mtime_ns}
+
+# bumped whenever a solver change alters the solutions, so that
+# SolutionCache entries of older versions are not used
+SOLVER_VERSION = 2
+
+class SolutionCache:
+    """
+    Solved worlds on disk, one .npz file per solution named by the hash of
+    the world contents (MDPWorld.content_hash), the solver parameters and
+    SOLVER_VERSION. Files are written under a temporary name and renamed,
+    so processes can share the directory; once it holds more than
+    max_bytes the least recently used ones (by modification time, which
+    a hit refreshes) are removed.
+    """
+
+    def __init__(self,directory,max_bytes=1<<30,keep_q=False):
+        """
+        :param directory: created if missing
+        :param max_bytes: size bound of the .npz files
+        :param keep_q: also store the (n_actions,n_states) Q of the
+        solutions
+        """
+        os.makedirs(directory,exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.keep_q = keep_q
+        self.hits = self.misses = 0
+
+    def key(self,world,**params):
+        raw = json.dumps({'world':world.content_hash(),'params':params,
+                          'version':SOLVER_VERSION},sort_keys=True)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def path(self,key):
+        return os.path.join(self.directory,key+'.npz')
+
+    def get(self,key):
+        """
+        :return: dictionary of the stored arrays, None on a miss
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as f:
+                arrays = {name:f[name] for name in f.files}
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # truncated or corrupt (BadZipFile, EOFError, ValueError...):
+            # removed so that the next put writes it again
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process meanwhile, the arrays are read
+            pass
+        self.hits += 1
+        return arrays
+
+    def put(self,key,**arrays):
+        fd,tmp = mkstemp(suffix='.tmp',dir=self.directory)
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**arrays)
+            os.replace(tmp,self.path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the rest fit in
+        max_bytes
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime_ns,stat.st_size,entry.path))
+        total = sum(size for _,size,_ in entries)
+        for _,size,path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        max_bytes,self.max_bytes = self.max_bytes,-1
+        self.evict()
+        self.max_bytes = max_bytes
+
+class PolicyTable:
+    """
+    Solved policy of a grid world held for lookups: the action index of
+    every flat cell (-1 where no action is taken), V and optionally the
+    action values Q, in read-only arrays that any number of readers can
+    share. Tables are saved to and loaded from .npz files; SolutionCache
+    entries load too, given the columns of the grid.
+    """
+
+    def __init__(self,cols,actions,policy,V,Q=None):
+        """
+        :param cols: columns of the grid
+        :param actions: action names, indexed by policy
+        :param policy: flat action indices, -1 for no action
+        :param V: flat values
+        :param Q: (n_actions,n_states) action values, as SolutionCache
+        stores them, or None
+        """
+        V = np.asarray(V,dtype=float).ravel()
+        if len(V)%cols:
+            raise ValueError('%d values do not fill %d columns'%(len(V),cols))
+        self.cols = cols
+        self.rows = len(V)//cols
+        self.actions = list(actions)
+        self.policy = _read_only(np.asarray(policy,dtype=np.int8).ravel())
+        self.V = _read_only(V)
+        # one row of action values per cell
+        self.Q = None if Q is None else \
+            _read_only(np.ascontiguousarray(np.asarray(Q,dtype=float).T))
+        if len(self.policy) != len(V) or \
+                (self.Q is not None and self.Q.shape != (len(V),len(actions))):
+            raise ValueError('policy, V and Q cover different cells')
+        self.version = hashlib.sha256(self.policy.tobytes()+V.tobytes()) \
+                       .hexdigest()[:16]
+        self._names = np.array(self.actions+[None],dtype=object)
+
+    def index(self,cells):
+        """
+        :param cells: (n,2) array of (x,y) cells
+        :return: flat indices of the cells and the mask of those inside
+        the grid (the others get index 0)
+        """
+        cells = np.asarray(cells,dtype=np.intp).reshape(-1,2)
+        x,y = cells[:,0],cells[:,1]
+        inside = (0 <= x)&(x < self.cols)&(0 <= y)&(y < self.rows)
+        return np.where(inside,y*self.cols+x,0),inside
+
+    def best_actions(self,index):
+        """
+        :return: action names of the flat cells, None for no action
+        """
+        return self._names[self.policy[index]]
+
+    def values(self,index):
+        return self.V[index]
+
+    def action_values(self,index):
+        """
+        :return: (n,n_actions) Q of the flat cells
+        """
+        if self.Q is None:
+            raise ValueError('the table holds no action values')
+        return self.Q[index]
+
+    def save(self,path):
+        """
+        Writes the table under a temporary name and renames it, so a
+        process watching path never reads half a file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd,tmp = mkstemp(suffix='.tmp',dir=directory)
+        arrays = {'policy':self.policy,'V':self.V,'cols':self.cols,
+                  'actions':np.array(self.actions)}
+        if self.Q is not None:
+            arrays['Q'] = self.Q.T
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**arrays)
+            os.replace(tmp,path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls,path,cols=None,actions=None):
+        """
+        :param cols: columns of the grid, needed for SolutionCache entries
+        :param actions: action names, the compass ones of MDPWorld if the
+        file does not hold them
+        """
+        with np.load(path) as f:
+            arrays = {name:f[name] for name in f.files}
+        if cols is None:
+            if 'cols' not in arrays:
+                raise ValueError(path+' does not hold the grid columns')
+            cols = int(arrays['cols'])
+        if actions is None:
+            actions = arrays['actions'].tolist() if 'actions' in arrays \
+                      else ['N','NE','E','SE','S','SW','W','NW']
+        return cls(cols,actions,arrays['policy'],arrays['V'],arrays.get('Q'))
+
+def _read_only(a):
+    a.flags.writeable = False
+    return a
+
+def noise_kernels(noise=0.3):
+    """
+    3x3 move probabilities of the eight compass actions: the intended
+    direction with probability 1-noise, the two next compass directions
+    with 2/3 of the noise and the two perpendicular ones with the rest
+    (noise=0.3 gives the kernels of the shipped problems)
+    :return: dictionary from action to its 3x3 matrix, north on top
+    """
+    compass = [(0,1),(1,1),(1,0),(1,-1),(0,-1),(-1,-1),(-1,0),(-1,1)]
+    names = ['N','NE','E','SE','S','SW','W','NW']
+    probs = {}
+    for i,name in enumerate(names):
+        p = np.zeros((3,3))
+        for turn,q in ((0,1-noise),(1,noise/3),(-1,noise/3),
+                       (2,noise/6),(-2,noise/6)):
+            dx,dy = compass[(i+turn)%8]
+            p[1-dy,dx+1] += q
+        probs[name] = np.asmatrix(p.round(12))
+    return probs
+
+def generate_world(rows,cols,obstacles=0.15,terminals=2,noise=0.3,
+                   step_reward=-0.04,seed=None):
+    """
+    Random grid world
+    :param obstacles: fraction of inaccesible cells
+    :param terminals: number of terminal cells, rewarded +1,-1,+1,...
+    :param noise: see noise_kernels
+    :param step_reward: reward of the accesible cells
+    :param seed: seed of the layout, also given to the world
+    """
+    rng = np.random.default_rng(seed)
+    types = np.where(rng.random((rows,cols)) < obstacles,
+                     INACCESIBLE,ACCESIBLE).astype(np.int8)
+    rewards = np.where(types == ACCESIBLE,step_reward,0.0)
+    open_cells = np.flatnonzero(types == ACCESIBLE)
+    if terminals > len(open_cells):
+        raise ValueError('more terminals than accesible cells')
+    cells = rng.choice(open_cells,size=terminals,replace=False)
+    types.flat[cells] = TERMINAL
+    rewards.flat[cells] = np.where(np.arange(terminals)%2 == 0,1.0,-1.0)
+    return MDPWorld.from_arrays(types,rewards,noise_kernels(noise),seed=seed)
+
+def write_mdp(world,filename):
+    """
+    Writes a world in the text .mdp format
+    """
+    def number(x):
+        # two decimals as in the shipped files, unless that loses digits
+        return '%5.2f'%x if round(x,2) == x else repr(float(x))
+    types = np.asarray(world.map.types)
+    rewards = np.asarray(world.map.rewards)
+    with open(filename,'w') as f:
+        f.write('%d %d\n'%types.shape)
+        for t,r in zip(types,rewards):
+            f.write(' '.join('%d %s'%(c,number(x)) for c,x in zip(t,r))+'\n')
+        for a in world.actions:
+            for row in np.asarray(world.probs[a]):
+                f.write(' '.join(number(p).strip() for p in row)+'\n')
 
 class MDPWorld:
     
-    def __init__(self,filename):
+    def __init__(self,filename=None,seed=None):
 
         self.types = {INACCESIBLE:'Inaccesible',
                       ACCESIBLE:'Accesible',
                       TERMINAL:'Terminal'}
         self.actions = ['N','NE','E','SE','S','SW','W','NW']
         self.n_actions = len(self.actions)
-        self.read(filename)
+        self.action_index = {a:i for i,a in enumerate(self.actions)}
+        self._model = None
+        self._model_key = None
+        self._probs_version = 0
+        self._solution = None
+        self._compiled = None
+        self.seed(seed)
+        if filename is not None:
+            self.read(filename)
+
+    @classmethod
+    def from_arrays(cls,types,rewards,probs,seed=None):
+        """
+        Builds a world without a .mdp file
+        :param types: (rows,cols) cell types
+        :param rewards: (rows,cols) rewards
+        :param probs: dictionary from action to its 3x3 move probabilities
+        """
+        world = cls(seed=seed)
+        world.filename = None
+        world.probs = {a:np.asmatrix(p) for a,p in probs.items()}
+        world.map = Map(types,rewards)
+        return world
+
+    def seed(self,seed=None):
+        """
+        Restarts the random stream used by every stochastic method
+        :param seed: anything np.random.default_rng accepts
+        """
+        self.rng = RandomStream(seed)
+
+    @property
+    def probs(self):
+        return self._probs
+
+    @probs.setter
+    def probs(self,probs):
+        # read-only, as the map arrays: edits assign a new dictionary
+        self._probs = MappingProxyType({a:_frozen_matrix(p) \
+                                        for a,p in probs.items()})
+        self._probs_version += 1
+
+    def __getstate__(self):
+        # mapping proxies do not pickle
+        state = self.__dict__.copy()
+        state['_probs'] = dict(self._probs)
+        return state
+
+    def __setstate__(self,state):
+        # unpickled arrays come back writeable
+        state['_probs'] = MappingProxyType({a:_frozen_matrix(p) \
+                                            for a,p in state['_probs'].items()})
+        self.__dict__.update(state)
+
+    @property
+    def model(self):
+        """
+        The compiled TransitionModel, rebuilt only when the map types or
+        the action probabilities were reassigned
+        """
+        key = (self.map,self.map.types_version,self._probs_version)
+        if self._model is None or self._model_key != key:
+            self._model = TransitionModel(self.map.types,
+                                          self.displacement_probs())
+            self._model_key = key
+        return self._model
         
     def read(self,filename):
+        """
+        Loads a world, memory mapping its compiled form when filename is
+        a compiled file or a fresh one exists next to it
+        """
+        if filename.endswith('.mdp'+COMPILED_SUFFIX):
+            self.read_compiled(filename)
+        elif compiled_is_fresh(filename):
+            self.read_compiled(compiled_path(filename))
+            self.filename = filename
+        else:
+            self.read_text(filename)
+
+    def read_compiled(self,path):
+        """
+        Maps the arrays of a compiled file read-only, so processes opening
+        the same world share its pages; edits go through new arrays
+        assigned to map.types, map.rewards or probs
+        """
+        header = read_compiled_header(path)
+        a = {name:np.memmap(path,dtype=info['dtype'],mode='r',
+                            offset=info['offset'],shape=tuple(info['shape'])) \
+             for name,info in header['arrays'].items()}
+        self.filename = path
+        self.probs = {action:np.asmatrix(p) \
+                      for action,p in zip(header['actions'],a['probs'])}
+        self.map = Map(a['types'],a['rewards'])
+        self._compiled = (self._contents_key(),path,header)
+
+    def _contents_key(self):
+        return (self.map,self.map.types_version,self.map.rewards_version,
+                self._probs_version)
+
+    def content_hash(self):
+        """
+        world_hash of the current types, rewards and probs. The arrays are
+        hashed on every call, as they may have been edited in place, but
+        for the compiled header hash while the world still holds the
+        read-only arrays mapped by read_compiled
+        """
+        compiled = self._compiled
+        probs = [self.probs[a] for a in self.actions]
+        if compiled is not None and compiled[0] == self._contents_key() and \
+           not any(np.asarray(a).flags.writeable \
+                   for a in [self.map.types,self.map.rewards]+probs):
+            return compiled[2]['hash']
+        return world_hash(self.map.types,self.map.rewards,np.array(probs))
+
+    def read_text(self,filename,dtype=np.float64):
+        """
+        Parses a text .mdp file with parse_mdp
+        :param dtype: dtype of the rewards
+        """
         self.filename = filename
-        with open(filename) as f:
-            lines = [l.strip() for l in f.readlines()]
-        rows,cols = map(int,lines[0].split())
-        map_info = [l.split() for l in lines[1:rows+1]]
-        types = [list(map(int,row[0::2])) for row in map_info]
-        rewards = [list(map(float,row[1::2])) for row in map_info]
-        self.probs = {}
-        for i in range(0,self.n_actions):
-            probs_info = [l.split() for l in lines[rows+3*i+1:rows+3*(i+1)+1]]
-            self.probs[self.actions[i]]=np.matrix(
-                    [list(map(float,row)) for row in probs_info])
+        types,rewards,kernels = parse_mdp(filename,self.n_actions,dtype)
+        self.probs = {a:np.asmatrix(p) for a,p in zip(self.actions,kernels)}
         self.map = Map(types,rewards)
         
     def attempt_location(self,x_prev, x_new):
@@ -527,49 +2079,176 @@ class MDPWorld:
 
     
     def reachable_state_probability_pairs(self,s,action):
-        probs = self.probs[action]
         #state probability pairs
-        sp = {}
-        for x in product([-1,0,1],[-1,0,1]):
-            pos = self.attempt_location(s,(x[0]+s[0],x[1]+s[1]))
-            prob = probs[::-1,:][(x[1]+1,x[0]+1)]
-            if prob > 0:
-                sp[pos] = sp[pos] + prob if pos in sp else prob
-        return sp
+        indices,probs = self.model.successors(
+            self.cell_index(s),self.action_index[action])
+        cols = self.map.cols
+        return {(int(i)%cols,int(i)//cols):p for i,p in zip(indices,probs)}
     
     def move(self,s,action):
-        #thresholds for stochastic simulation
-        ths = np.cumsum(self.probs[action][::-1,:]).reshape(3,3)
-        r = np.random.uniform()
-        m = np.where(r<=ths)
-        pos = min(zip(m[0],m[1]))
-        #changed index order
-        s_p = self.attempt_location(
-            s,(s[0]+int(pos[1])-1,s[1]+int(pos[0])-1))
+        s_p = self.model.sample(self.cell_index(s),
+                                self.action_index[action],
+                                self.rng.random())
+        s_p = (s_p%self.map.cols,s_p//self.map.cols)
         return (s_p,self.reward_of_cell(s_p))
         
-    def simulate(self,pi,n,x=(0,0)):
-        self.map.animate_move(x,x,reset=True)
-        #rows and columns are swaped in the matrix
-        cumreward = self.reward_of_cell(x)
+    def move_batch(self,states,actions,u=None):
+        """
+        Moves many independent agents one step
+        :param states: flat cell indices of the agents
+        :param actions: action indices, one per agent
+        :param u: uniform draws, one per agent, taken from the world
+        random stream if not given
+        :return: next states, their rewards and whether they are terminal
+        """
+        states = np.asarray(states)
+        if u is None:
+            u = self.rng.take(states.shape)
+        model = self.model
+        s_p = model.sample_batch(states,actions,u)
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        return s_p,R[s_p],model.terminal[s_p]
+        
+    @staticmethod
+    def _renderer(animate):
+        # animate or render is True or a Renderer
+        return animate if isinstance(animate,Renderer) else None
+
+    def simulate(self,pi,n,x=(0,0),render=True):
+        """
+        Follows pi for at most n moves from cell x
+        :param pi: {(x,y):action} policy or flat array of action indices
+        (see policy_array)
+        :param render: animate the trajectory, or a Renderer to throttle
+        the animation, False runs without matplotlib
+        :return: the cumulative reward
+        """
+        if render:
+            self.map.animate_move(x,x,reset=True,renderer=self._renderer(
+                render))
+        model = self.model
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        cols = self.map.cols
+        as_array = isinstance(pi,np.ndarray)
+        s = self.cell_index(x)
+        cumreward = R[s]
+        moves = 0
         for i in range(n):
-            x_prev = x
-            x,reward = self.move(x,pi[x])
-            cumreward += reward
-            self.map.animate_move(x_prev,x,cumreward=cumreward)
-            if self.terminal_cell(x):
+            s_prev = s
+            if as_array:
+                a = int(pi[s])
+            else:
+                a = self.action_index[pi[(s%cols,s//cols)]]
+            if a < 0:
+                raise ValueError('pi has no action for cell (%d,%d)'
+                                 %(s%cols,s//cols))
+            s = model.sample(s,a,self.rng.random())
+            cumreward += R[s]
+            moves += 1
+            done = model.terminal[s]
+            if render:
+                self.map.animate_move((s_prev%cols,s_prev//cols),
+                                      (s%cols,s//cols),cumreward=cumreward,
+                                      force=done or i == n-1)
+            if done:
                 break
+        self.stats = {'moves':moves}
         return cumreward
+
+    def evaluate_policy(self,pi,episodes=10000,steps=1000,starts=None,
+                        gamma=1.,confidence=0.95,render=False):
+        """
+        Monte-Carlo evaluation of pi, all the episodes stepped together
+        :param pi: {(x,y):action} policy or flat array of action indices
+        :param episodes: number of rollouts
+        :param steps: maximum number of moves of each rollout
+        :param starts: start distribution: None for uniform over the
+        accesible cells, an (x,y) cell, an array of flat start states (one
+        per episode) or a probability vector over the flat cells
+        :param gamma: discount of the rewards, 1 adds them up as simulate
+        :param confidence: level of the confidence interval of the mean
+        :param render: animate one of the rollouts with simulate
+        :return: dictionary with the mean, std and confidence interval
+        (ci) of the returns, the termination rate, the mean length and the
+        returns, lengths and terminated arrays of every episode
+        """
+        model = self.model
+        P = pi if isinstance(pi,np.ndarray) else self.pi_to_array(pi)
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        generator = self.rng.generator
+        if starts is None:
+            starts = generator.choice(np.flatnonzero(model.accesible),
+                                      size=episodes)
+        elif isinstance(starts,tuple):
+            starts = np.full(episodes,self.cell_index(starts),dtype=np.intp)
+        else:
+            starts = np.asarray(starts)
+            if starts.dtype.kind == 'f':
+                starts = generator.choice(len(starts),size=episodes,
+                                          p=starts/starts.sum())
+            episodes = len(starts)
+        returns = R[starts]
+        lengths = np.zeros(episodes,dtype=np.intp)
+        terminated = model.terminal[starts].copy()
+        # only the running episodes are stepped
+        active = np.flatnonzero(~terminated)
+        s = starts[active]
+        discount = 1.
+        for t in range(steps):
+            if not len(s):
+                break
+            a = P[s]
+            if a.min() < 0:
+                raise ValueError('pi has no action for cell (%d,%d)'
+                                 %(s[a.argmin()]%self.map.cols,
+                                   s[a.argmin()]//self.map.cols))
+            s = model.sample_batch(s,a,self.rng.take(len(s)))
+            discount *= gamma
+            returns[active] += discount*R[s]
+            lengths[active] += 1
+            done = model.terminal[s]
+            if done.any():
+                terminated[active[done]] = True
+                active,s = active[~done],s[~done]
+        mean = returns.mean()
+        std = returns.std(ddof=1) if episodes > 1 else 0.
+        half = NormalDist().inv_cdf(0.5+confidence/2)*std/sqrt(episodes)
+        if render:
+            s = int(starts[0])
+            self.simulate(P,steps,(s%self.map.cols,s//self.map.cols),render)
+        self.stats = {'episodes':episodes,'moves':int(lengths.sum())}
+        return {'mean':float(mean),'std':float(std),
+                'ci':(float(mean-half),float(mean+half)),
+                'termination_rate':float(terminated.mean()),
+                'mean_length':float(lengths.mean()),
+                'returns':returns,'lengths':lengths,'terminated':terminated}
             
-    def random_pi(self):
+    def random_pi(self,as_array=False):
+        """
+        Uniformly random action in every cell
+        :param as_array: return the flat int8 array of action indices
+        instead of the {(x,y):action} dict
+        """
+        n = self.map.rows*self.map.cols
+        if as_array:
+            # the same draws as the dict, cell by cell in its order
+            P = np.empty(n,dtype=np.int8)
+            P[self._product_order()] = self.rng.generator.choice(
+                self.n_actions,n)
+            return P
         pi = {p:a for p,a in \
               zip(product(range(self.map.cols),range(self.map.rows)),
-              np.random.choice(self.actions,self.map.rows*self.map.cols))}
+              self.rng.generator.choice(self.actions,n))}
         return pi
     
     def expected_reward(self,cell, action,V):
-        return sum(map(lambda i:V[i[0]]*i[1],
-            self.reachable_state_probability_pairs(cell,action).items()))
+        # V is either the {(x,y):v} dict or a flat value array
+        if isinstance(V,dict):
+            return sum(map(lambda i:V[i[0]]*i[1],
+                self.reachable_state_probability_pairs(cell,action).items()))
+        indices,probs = self.model.successors(
+            self.cell_index(cell),self.action_index[action])
+        return float(probs @ V[indices])
         
     def accesible_cell(self, cell):
         return self.map.types [(cell[1],cell[0])] == ACCESIBLE
@@ -580,72 +2259,1231 @@ class MDPWorld:
     def reward_of_cell(self,cell):
         return self.map.rewards[(cell[1],cell[0])]
     
-    def compute_v(self,gamma,animate=False,epsilon=1.e-9):
+    def cell_index(self,cell):
+        # flat row-major index of the (x,y) cell
+        return cell[1]*self.map.cols+cell[0]
+
+    def values_dict(self,V):
+        # flat value array back to the {(x,y):v} form
+        cols = self.map.cols
+        return {cell:V[cell[1]*cols+cell[0]] \
+                for cell in product(range(self.map.cols),range(self.map.rows))}
+
+    def pi_to_array(self,pi):
+        """
+        :param pi: {(x,y):action} policy
+        :return: flat int8 array with the action index of every cell, -1
+        for the cells pi leaves out
+        """
+        P = np.full(self.map.rows*self.map.cols,-1,dtype=np.int8)
+        cols = self.map.cols
+        for cell,action in pi.items():
+            P[cell[1]*cols+cell[0]] = self.action_index[action]
+        return P
+
+    def array_to_pi(self,P):
+        """
+        :param P: flat array of action indices, -1 for no action
+        :return: {(x,y):action} policy of the cells with an action
+        """
+        P = np.asarray(P)
+        cols = self.map.cols
+        index = self._product_order()
+        index = index[P[index] >= 0]
+        names = np.array(self.actions,dtype=object)[P[index]]
+        return dict(zip(zip((index%cols).tolist(),(index//cols).tolist()),
+                        names.tolist()))
+
+    def _product_order(self):
+        # flat indices of the cells in product(range(cols),range(rows))
+        # order, that of the policy and value dicts
+        cols = self.map.cols
+        return (np.arange(self.map.rows)*cols+np.arange(cols)[:,None]).ravel()
+
+    def policy_array(self,best):
+        """
+        Compact policy: the int8 action index of every accesible cell and
+        -1 for the others, where no action is taken
+        :param best: flat action indices of every cell
+        """
+        return np.where(self.model.accesible,best,-1).astype(np.int8)
+
+    def displacement_probs(self):
+        """
+        Move probabilities of every action for the nine displacements in
+        product([-1,0,1],[-1,0,1]) order
+        :return: (n_actions,9) array
+        """
+        return np.array([[self.probs[a][::-1,:][(dy+1,dx+1)] \
+                          for dx,dy in product([-1,0,1],[-1,0,1])] \
+                         for a in self.actions])
+
+    def action_values(self,V):
+        # expected value of the next state for every action and cell
+        return self.model.action_values(V)
+
+    def compute_v_array(self,gamma,animate=False,epsilon=1.e-9,
+                        callback=None,profile=False,method='jacobi',
+                        stopping='residual',omega=1.3,memory=3):
+        """
+        Value iteration over the flat row-major grid
+        :param gamma: the discount factor
+        :param animate: redraw the value function, at most 10 times a
+        second, or the Renderer of the redraws
+        :param epsilon: maximum distance to the optimal value function
+        :param callback: called with a record of every sweep, see
+        ConvergenceLog
+        :param profile: add backup_time and residual_time to the records
+        :param method: 'jacobi' backs up every cell from the values of the
+        previous sweep, 'gauss-seidel' updates in place, four interleaved
+        blocks of cells at a time ((x%2,y%2), no two of them neighbours),
+        'sor' is gauss-seidel moving the values omega times their backed
+        up change, 'anderson' extrapolates the jacobi sweeps from the last
+        ones (see anderson_iteration), 'prioritized' backs up one cell at
+        a time, the one of largest Bellman error first (see
+        prioritized_sweeping)
+        :param stopping: 'residual' stops once the largest change of a
+        sweep is below epsilon*(1-gamma)/gamma, which needs gamma < 1;
+        'span' once the span (max-min) of the changes is, taking the cells
+        that are not backed up as changing by 0, and below epsilon for
+        gamma = 1, an undiscounted world whose terminals absorb
+        :param omega: relaxation factor of 'sor', between 1 and 2
+        :param memory: sweeps extrapolated from by 'anderson'
+        :return: flat array with V of every cell
+        """
+        threshold = self._threshold(gamma,epsilon,stopping)
+        if method == 'prioritized':
+            if stopping != 'residual':
+                raise ValueError('prioritized sweeping stops on the residual')
+            return self.prioritized_sweeping(gamma,epsilon,callback)
+        if method == 'anderson':
+            return self.anderson_iteration(gamma,epsilon,memory,stopping,
+                                           callback)
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        V = np.where(self.model.terminal,R,0.0)
+        return self._sweeps(V,R,gamma,threshold,method,stopping,omega,
+                            animate,callback,profile)
+
+    def _sweeps(self,V,R,gamma,threshold,method='jacobi',
+                stopping='residual',omega=1.3,animate=False,callback=None,
+                profile=False):
+        # the sweeps of compute_v_array from V, updated in place, for the
+        # flat rewards R
         error = inf
-            
-        V = {cell:0.0 \
-             if not self.terminal_cell(cell) else self.reward_of_cell(cell) \
-             for cell in product(range(self.map.cols),range(self.map.rows))}
-        if animate == True:
-            self.map.animate_Vs(V,error,reset=True)
-        while error > epsilon*(1-gamma)/gamma:
-            V_prev = V.copy()
-            for cell in filter(lambda x:self.accesible_cell(x),V.keys()):
-                V[cell] = self.reward_of_cell(cell)+ \
-                gamma*max([self.expected_reward(cell,action,V) \
-                     for action in self.actions])
-            error = max([abs(V[k]-V_prev[k]) for k in V.keys()])
+        model = self.model
+        # only accesible cells are backed up, the rest keep their value
+        cells = np.flatnonzero(model.accesible)
+        if method == 'jacobi':
+            blocks = [cells]
+        elif method in ('gauss-seidel','sor'):
+            x,y = cells%self.map.cols,cells//self.map.cols
+            colour = (y%2)*2+x%2
+            blocks = [cells[colour == c] for c in range(4)]
+        else:
+            raise ValueError('unknown method: '+str(method))
+        blocks = [(block,model.targets[:,block],R[block]) for block in blocks]
+        kernels = model.kernels
+        if animate:
+            self.map.animate_Vs(V,error,reset=True,
+                                renderer=self._renderer(animate))
+        relax = omega if method == 'sor' else 1.0
+        sweeps = 0
+        best = None
+        while error > threshold:
+            if callback is not None:
+                start = perf_counter()
+                backup_time = 0.0
+                actions = []
+            high = low = 0.0
+            backed_up = []
+            for block,targets,R_block in blocks:
+                if callback is not None:
+                    block_start = perf_counter()
+                Q = kernels @ V[targets]
+                V_block = R_block+gamma*Q.max(axis=0)
+                change = V_block-V[block]
+                if callback is not None:
+                    backup_time += perf_counter()-block_start
+                    actions.append(Q.argmax(axis=0))
+                high = max(high,change.max(initial=0.0))
+                low = min(low,change.min(initial=0.0))
+                if relax == 1.0:
+                    V[block] = V_block
+                else:
+                    backed_up.append(V_block)
+                    V[block] += relax*change
+            error_prev = error
+            error = high-low if stopping == 'span' else max(high,-low)
+            if error <= threshold and backed_up:
+                # the stopping rule bounds the error of the backed up
+                # values, not of their over-relaxed moves
+                for (block,_,_),V_block in zip(blocks,backed_up):
+                    V[block] = V_block
+            if error > error_prev and relax > 1.0:
+                # over-relaxing a max may diverge: halve the excess
+                relax = 1.0+(relax-1.0)/2 if relax > 1.01 else 1.0
+            sweeps += 1
+            if callback is not None:
+                end = perf_counter()
+                best_prev,best = best,np.concatenate(actions)
+                record = {'solver':'compute_v','sweep':sweeps,
+                          'residual':float(error),
+                          'policy_changes':None if best_prev is None else \
+                              int(np.count_nonzero(best != best_prev)),
+                          'time':end-start,
+                          'backups_per_s':len(cells)*self.n_actions/(end-start)}
+                if profile:
+                    record['backup_time'] = backup_time
+                    record['residual_time'] = end-start-backup_time
+                callback(record)
             if animate:
-                self.map.animate_Vs(V,error)
+                self.map.animate_Vs(V,error,force=error <= threshold)
+        self.stats = {'sweeps':sweeps,
+                      'backups':sweeps*len(cells)*self.n_actions}
+        return V
+
+    def compute_v_batch(self,gammas,rewards=None,epsilon=1.e-9,tile=8192,
+                        stopping='residual',min_batch=2):
+        """
+        Value iteration of K variants of the world at once, differing in
+        the discount factor and/or the rewards. V holds one column per
+        variant, so the successors of a cell are gathered once for all of
+        them and a block of cells is backed up by a single product; every
+        variant stops on the rule of compute_v_array for its own gamma and
+        leaves the sweeps when it does. Only the gathers are shared, the
+        products and maxima grow with K, so the time stays about linear in
+        K. Fewer than min_batch variants are swept by compute_v_array.
+        :param gammas: K discount factors, or one shared by the variants
+        :param rewards: K reward grids (K,rows,cols) or flat (K,n_states),
+        the rewards of the map by default
+        :param epsilon: maximum distance to the optimal value functions
+        :param tile: values backed up per product, small enough for the
+        temporaries to stay in cache
+        :param stopping: 'residual' or 'span', see compute_v_array
+        :param min_batch: variants below which the ones still sweeping
+        are solved one at a time
+        :return: (n_states,K) array, V of every cell for every variant
+        """
+        model = self.model
+        n = model.n_states
+        R = np.asarray(self.map.rewards if rewards is None else rewards,
+                       dtype=float).reshape(-1,n)
+        gammas = np.atleast_1d(np.asarray(gammas,dtype=float))
+        K = np.broadcast_shapes(gammas.shape,R.shape[:1])[0]
+        gammas = np.broadcast_to(gammas,(K,))
+        R = np.broadcast_to(R,(K,n)).T
+        V = np.where(model.terminal[:,None],R,0.0)
+        cells = np.flatnonzero(model.accesible)
+        targets = np.ascontiguousarray(model.targets[:,cells])
+        kernels = model.kernels
+        thresholds = np.array([self._threshold(g,epsilon,stopping) \
+                               for g in gammas.tolist()])
+        sweeps = np.zeros(K,dtype=int)
+        # variants still sweeping, their values in W
+        active = np.arange(K)
+        # the sweeps read W and write W_next, swapping them
+        W = V.copy()
+        W_next = V.copy()
+        R_cells = R[cells]
+        while len(active) >= min_batch:
+            k = len(active)
+            step = max(tile//k,1)
+            g = gammas[active]
+            # largest rise and fall of the values of every variant
+            high = np.zeros(k)
+            low = np.zeros(k)
+            # each row of W as a single item, gathered as fast as a vector
+            item = np.dtype((np.void,W.itemsize*k))
+            rows = W.view(item)[:,0]
+            rows_next = W_next.view(item)[:,0]
+            for c in range(0,len(cells),step):
+                G = np.take(rows,targets[:,c:c+step]).view(float) \
+                      .reshape(9,-1,k)
+                Q = (kernels @ G.reshape(9,-1)).reshape(len(kernels),-1,k)
+                W_cells = Q.max(axis=0)
+                W_cells *= g
+                W_cells += R_cells[c:c+step]
+                # the (0,0) displacement of an accesible cell is the cell
+                change = W_cells-G[4]
+                if stopping == 'span':
+                    np.maximum(high,_column_reduce(np.max,change),out=high)
+                    np.minimum(low,_column_reduce(np.min,change),out=low)
+                else:
+                    np.abs(change,out=change)
+                    np.maximum(high,_column_reduce(np.max,change),out=high)
+                rows_next[cells[c:c+step]] = W_cells.view(item)[:,0]
+            W,W_next = W_next,W
+            sweeps[active] += 1
+            error = high-low
+            done = error <= thresholds[active]
+            if done.any():
+                V[:,active[done]] = W[:,done]
+                active = active[~done]
+                W = np.ascontiguousarray(W[:,~done])
+                W_next = W.copy()
+                R_cells = np.ascontiguousarray(R_cells[:,~done])
+        # too few variants left to share the gathers: the sweeps of
+        # compute_v_array, one variant at a time
+        for j,variant in enumerate(active.tolist()):
+            V[:,variant] = self._sweeps(W[:,j].copy(),R[:,variant].copy(),
+                                        gammas[variant],thresholds[variant],
+                                        stopping=stopping)
+            sweeps[variant] += self.stats['sweeps']
+        self.stats = {'sweeps':sweeps.tolist(),
+                      'backups':int(sweeps.sum())*len(cells)*self.n_actions}
+        return V
+
+    def _row_reader(self,name):
+        """
+        Function returning rows r0:r1 of the types or rewards. Worlds read
+        from a compiled file and not changed since map just those rows,
+        and drop them from memory when the strip is done with them.
+        """
+        compiled = self._compiled
+        if compiled is not None and compiled[0] == self._contents_key():
+            path,info = compiled[1],compiled[2]['arrays'][name]
+            dtype = np.dtype(info['dtype'])
+            rows,cols = info['shape']
+
+            def read(r0,r1):
+                return np.array(np.memmap(path,dtype=dtype,mode='r',
+                                          offset=info['offset']+
+                                                 r0*cols*dtype.itemsize,
+                                          shape=(r1-r0,cols)))
+            return read
+        a = np.asarray(getattr(self.map,name))
+        return lambda r0,r1:a[r0:r1]
+
+    def compute_v_tiled(self,gamma,epsilon=1.e-6,path=None,dtype=np.float32,
+                        max_memory=64<<20,callback=None):
+        """
+        Value iteration for grids larger than memory. V lives in a
+        memory-mapped file of dtype and the grid is swept in strips of
+        whole rows, each read with one halo row above and below since
+        moves only reach the 3x3 neighbourhood (see backup_rows). The
+        strips are updated in place, top to bottom, which keeps the
+        contraction of the sweep; the stopping rule also accounts for the
+        rounding of V to dtype, so the result is within epsilon of the
+        optimal value function as with compute_v_array.
+        :param gamma: the discount factor, below 1
+        :param epsilon: maximum distance to the optimal value function,
+        above the resolution of dtype
+        :param path: file for V, a temporary one by default
+        :param dtype: dtype of the stored values
+        :param max_memory: bytes of working memory for a strip, which sets
+        its height
+        :param callback: called with a record of every sweep
+        :return: (rows,cols) memory-mapped V
+        """
+        if gamma >= 1:
+            raise ValueError('compute_v_tiled needs gamma < 1, the residual '
+                             'never bounds the error at gamma = 1')
+        read_types = self._row_reader('types')
+        read_rewards = self._row_reader('rewards')
+        rows,cols = self.map.rows,self.map.cols
+        kernels = self.displacement_probs()
+        # float64 bytes per cell of a strip: the nine displacements, the
+        # action values and the strip arrays
+        height = min(max_memory//(cols*8*(9+self.n_actions+8)),rows)
+        if height < 1:
+            raise ValueError('max_memory of %d bytes is below one row'
+                             %max_memory)
+        strips = [(r0,min(r0+height,rows)) for r0 in range(0,rows,height)]
+        if path is None:
+            path = TemporaryFile()
+        V = np.memmap(path,dtype=dtype,mode='w+',shape=(rows,cols))
+        for r0,r1 in strips:
+            V[r0:r1] = np.where(read_types(r0,r1) == TERMINAL,
+                                read_rewards(r0,r1),0.0)
+        # a stored value is off by up to half an ulp of dtype; stopping
+        # when gamma*error plus that rounding is below epsilon*(1-gamma)
+        # bounds the distance to the optimum by epsilon
+        ulp = 0.5*np.finfo(dtype).eps
+        blank = np.zeros((1,cols))
+        sweeps = 0
+        while True:
+            if callback is not None:
+                start = perf_counter()
+            error = v_max = 0.0
+            for r0,r1 in strips:
+                lo,hi = max(r0-1,0),min(r1+1,rows)
+                # halo rows outside the grid are blocked
+                top,bottom = blank[:int(lo == r0)],blank[:int(hi == r1)]
+                V_strip = np.concatenate([top,V[lo:hi],bottom])
+                types = np.concatenate([top+INACCESIBLE,read_types(lo,hi),
+                                        bottom+INACCESIBLE])
+                backed_up = backup_rows(V_strip,types,read_rewards(r0,r1),
+                                        kernels,gamma).astype(dtype)
+                error = max(error,float(np.abs(backed_up-V_strip[1:-1]).max()))
+                v_max = max(v_max,float(np.abs(backed_up).max()))
+                V[r0:r1] = backed_up
+            sweeps += 1
+            if callback is not None:
+                callback({'solver':'compute_v_tiled','sweep':sweeps,
+                          'residual':error,'time':perf_counter()-start,
+                          'strips':len(strips)})
+            rounding = ulp*v_max
+            if rounding >= epsilon*(1-gamma):
+                raise ValueError('epsilon %g is below the resolution of %s'
+                                 %(epsilon,np.dtype(dtype).name))
+            if gamma*error+rounding <= epsilon*(1-gamma):
+                break
+        V.flush()
+        self.stats = {'sweeps':sweeps,'strips':len(strips),'height':height,
+                      'backups':sweeps*rows*cols*self.n_actions}
+        return V
+
+    def compute_v_parallel(self,gamma,epsilon=1.e-9,workers=None,
+                           callback=None):
+        """
+        compute_v_array split over processes, each backing up a strip of
+        whole rows. The types, rewards and two value buffers live in
+        shared memory: a sweep reads one buffer, halo rows of the
+        neighbouring strips included, and writes the other, so the halos
+        are exchanged by a barrier per sweep, where the maximum of the
+        strip residuals is also taken. The sweeps are the Jacobi sweeps
+        of compute_v_array with the same stopping rule.
+        :param gamma: the discount factor, below 1
+        :param epsilon: maximum distance to the optimal value function
+        :param workers: number of processes, os.cpu_count() by default
+        :param callback: called with a record of every sweep
+        :return: flat array with V of every cell
+        """
+        # the workers stop on the residual, which needs gamma < 1
+        threshold = self._threshold(gamma,epsilon,'residual',span=False)
+        import multiprocessing
+        from threading import BrokenBarrierError
+        rows,cols = self.map.rows,self.map.cols
+        workers = max(1,min(workers or os.cpu_count(),rows))
+        types = np.asarray(self.map.types,dtype=np.int8)
+        R = np.asarray(self.map.rewards,dtype=float)
+        V = np.zeros((2,rows,cols))
+        V[0] = np.where(types == TERMINAL,R,0.0)
+        bounds = np.linspace(0,rows,workers+1).round().astype(int)
+        context = multiprocessing.get_context()
+        # the workers and this process, which only watches the residuals
+        barrier = context.Barrier(workers+1)
+        shm,spec = share_arrays({'types':types,'rewards':R,'V':V,
+                                 'residual':np.zeros((2,workers))})
+        processes = [context.Process(target=_strip_worker,
+                                     args=(spec,i,bounds[i],bounds[i+1],
+                                           self.displacement_probs(),gamma,
+                                           threshold,barrier),
+                                     daemon=True) \
+                     for i in range(workers)]
+        view,shared = attach_arrays(spec)
+        residual = shared['residual']
+        try:
+            for p in processes:
+                p.start()
+            sweeps = 0
+            while True:
+                if callback is not None:
+                    start = perf_counter()
+                try:
+                    barrier.wait()
+                except BrokenBarrierError:
+                    raise RuntimeError('a compute_v_parallel worker failed') \
+                        from None
+                error = residual[sweeps%2].max()
+                sweeps += 1
+                if callback is not None:
+                    callback({'solver':'compute_v_parallel','sweep':sweeps,
+                              'residual':float(error),
+                              'time':perf_counter()-start,'workers':workers})
+                if error <= threshold:
+                    break
+            V = shared['V'][sweeps%2].ravel().copy()
+        except BaseException:
+            barrier.abort()
+            raise
+        finally:
+            for p in processes:
+                p.join()
+            shared.clear()
+            del residual
+            view.close()
+            shm.close()
+            shm.unlink()
+        cells = np.count_nonzero(types == ACCESIBLE)
+        self.stats = {'sweeps':sweeps,'workers':workers,
+                      'backups':sweeps*int(cells)*self.n_actions}
+        return V
+
+    def compute_optimal_pi_batch(self,gammas,rewards=None,epsilon=1.e-9,
+                                 stopping='residual'):
+        """
+        Optimal policies of K variants of the world, see compute_v_batch
+        :return: (n_states,K) values and the K {(x,y):action} policies
+        """
+        V = self.compute_v_batch(gammas,rewards,epsilon,stopping=stopping)
+        model = self.model
+        n,K = V.shape
+        Q = (model.kernels @ V[model.targets].reshape(9,-1)).reshape(-1,n,K)
+        best = Q.argmax(axis=0)
+        cells = list(product(range(self.map.cols),range(self.map.rows)))
+        index = [cell[1]*self.map.cols+cell[0] for cell in cells]
+        actions = np.array(self.actions)[best[index]]
+        return V,[dict(zip(cells,column.tolist())) for column in actions.T]
+
+    @staticmethod
+    def _threshold(gamma,epsilon,stopping,span=True):
+        # the error of a sweep below which value iteration stops, span
+        # telling whether the solver can stop on the span instead
+        if stopping == 'residual':
+            if gamma >= 1:
+                raise ValueError("the residual never bounds the error at "
+                                 "gamma = 1"+
+                                 (", use stopping='span'" if span else ''))
+            return epsilon*(1-gamma)/gamma
+        if stopping == 'span':
+            return epsilon*(1-gamma)/gamma if gamma < 1 else epsilon
+        raise ValueError('unknown stopping: '+str(stopping))
+
+    def anderson_iteration(self,gamma,epsilon=1.e-9,memory=3,
+                           stopping='residual',callback=None):
+        """
+        Value iteration with Anderson acceleration: the next values are
+        the combination of the last memory+1 backed up value functions
+        whose residuals (backed up minus backed up from) cancel out best,
+        in the least squares sense. When the residual grows (2-norm) the
+        history is dropped and a plain sweep is taken. The stopping rule is that
+        of compute_v_array on the residual, which bounds the error of the
+        backed up values whatever the values they come from.
+        :return: flat array with V of every cell
+        """
+        threshold = self._threshold(gamma,epsilon,stopping)
+        model = self.model
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        V = np.where(model.terminal,R,0.0)
+        cells = np.flatnonzero(model.accesible)
+        targets,R_cells = model.targets[:,cells],R[cells]
+        kernels = model.kernels
+        dF,dG = [],[]
+        f_prev = g_prev = None
+        sweeps = resets = 0
+        while True:
+            if callback is not None:
+                start = perf_counter()
+            g = R_cells+gamma*(kernels @ V[targets]).max(axis=0)
+            f = g-V[cells]
+            high,low = f.max(initial=0.0),f.min(initial=0.0)
+            error = high-low if stopping == 'span' else max(high,-low)
+            sweeps += 1
+            if callback is not None:
+                callback({'solver':'anderson_iteration','sweep':sweeps,
+                          'residual':float(error),'history':len(dF),
+                          'time':perf_counter()-start})
+            if error <= threshold:
+                V[cells] = g
+                break
+            if f_prev is not None:
+                if np.dot(f,f) > np.dot(f_prev,f_prev):
+                    dF,dG = [],[]
+                    resets += 1
+                else:
+                    dF.append(f-f_prev)
+                    dG.append(g-g_prev)
+                    del dF[:-memory],dG[:-memory]
+            f_prev,g_prev = f,g
+            if dF:
+                coefs = np.linalg.lstsq(np.stack(dF,axis=1),f,rcond=None)[0]
+                V[cells] = g-np.stack(dG,axis=1) @ coefs
+            else:
+                V[cells] = g
+        self.stats = {'sweeps':sweeps,'resets':resets,
+                      'backups':sweeps*len(cells)*self.n_actions}
+        return V
+
+    def prioritized_sweeping(self,gamma,epsilon=1.e-9,callback=None):
+        """
+        Asynchronous value iteration backing up one cell at a time, the
+        one of largest Bellman error |BV(s)-V(s)| first, from a heap; the
+        values spread out from the terminals. After every backup the
+        errors of the predecessors of the cell are recomputed through the
+        predecessor index. Once no error is above epsilon*(1-gamma)/gamma a
+        last synchronous sweep gives the same guarantee as compute_v_array.
+        :param gamma: the discount factor, below 1
+        :param epsilon: maximum distance to the optimal value function
+        :param callback: called with a record every len(cells) updates
+        :return: flat array with V of every cell
+        """
+        model = self.model
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        V = np.where(model.terminal,R,0.0)
+        cells = np.flatnonzero(model.accesible)
+        kernels = model.kernels
+        targets = model.targets
+        pred_ptr,pred_index = model.predecessors()
+        threshold = self._threshold(gamma,epsilon,'residual',span=False)
+        # probability of staying put under every action: a backup solves
+        # v = max(R+gamma*(Q-stay*v)) for v instead of plugging in V[s],
+        # leaving no error at s
+        stay = kernels @ (targets == np.arange(len(V)))
+        # Bellman errors, kept up to date for every accesible cell
+        error = np.zeros(len(V))
+        backed_up = R[cells]+gamma*(kernels @ V[targets[:,cells]]).max(axis=0)
+        error[cells] = np.abs(backed_up-V[cells])
+        heap = [(-e,s) for e,s in zip(error[cells].tolist(),cells.tolist()) \
+                if e > threshold]
+        heapify(heap)
+        # cell backups, the error updates included
+        updates = 0
+        backups = len(cells)
+        if callback is not None:
+            start = perf_counter()
+        while heap:
+            e,s = heappop(heap)
+            if -e != error[s]:
+                # stale entry, s was pushed again with its current error
+                continue
+            p = stay[:,s]
+            c = R[s]+gamma*(kernels @ V[targets[:,s]]-p*V[s])
+            V[s] = (c/(1-gamma*p)).max()
+            error[s] = 0.0
+            updates += 1
+            preds = pred_index[pred_ptr[s]:pred_ptr[s+1]]
+            backups += 1+len(preds)
+            Q = kernels @ V[targets[:,preds]]
+            e_preds = np.abs(R[preds]+gamma*Q.max(axis=0)-V[preds])
+            error[preds] = e_preds
+            for t,e in zip(preds.tolist(),e_preds.tolist()):
+                if e > threshold:
+                    heappush(heap,(-e,t))
+            if callback is not None and updates%len(cells) == 0:
+                end = perf_counter()
+                callback({'solver':'prioritized_sweeping',
+                          'sweep':updates//len(cells),
+                          'residual':-heap[0][0] if heap else 0.0,
+                          'time':end-start,
+                          'backups_per_s':len(cells)*self.n_actions/(end-start)})
+                start = end
+        # every error is below the threshold: one synchronous backup
+        V[cells] = R[cells]+gamma*(kernels @ V[targets[:,cells]]).max(axis=0)
+        backups += len(cells)
+        self.stats = {'updates':updates,'sweeps':backups/len(cells),
+                      'backups':backups*self.n_actions}
         return V
+
+    def compute_v(self,gamma,animate=False,epsilon=1.e-9,callback=None,
+                  profile=False,method='jacobi',stopping='residual',
+                  cache=None):
+        if cache is not None:
+            # solved and stored by compute_optimal_pi
+            self.compute_optimal_pi(gamma,epsilon,callback,profile,method,
+                                    stopping,cache)
+            return self.values_dict(self._solution['V'])
+        return self.values_dict(
+                self.compute_v_array(gamma,animate=animate,epsilon=epsilon,
+                                     callback=callback,profile=profile,
+                                     method=method,stopping=stopping))
                 
-    def compute_optimal_pi(self,gamma,epsilon=1.e-9):
-        Vs = self.compute_v(gamma,animate=False,epsilon=epsilon)
-        pi = {}
-        for cell,v in Vs.items():
-                pi[cell] = max([(action,self.expected_reward(cell,action,Vs))\
-                     for action in self.actions],key=lambda c:c[1])[0]       
-        return pi     
+    def compute_optimal_pi(self,gamma,epsilon=1.e-9,callback=None,
+                           profile=False,method='jacobi',stopping='residual',
+                           cache=None):
+        """
+        Greedy policy of the value function of compute_v_array
+        :param cache: SolutionCache the solution is looked up in first and
+        stored to after solving
+        :return: {(x,y):action} policy of every cell
+        """
+        V,best = self._optimal_actions(gamma,epsilon,callback,profile,
+                                       method,stopping,cache)
+        pi = self.array_to_pi(best)
+        self._keep_solution(gamma,V,best,pi)
+        return pi
+
+    def compute_optimal_pi_array(self,gamma,epsilon=1.e-9,callback=None,
+                                 profile=False,method='jacobi',
+                                 stopping='residual',cache=None):
+        """
+        compute_optimal_pi as a policy array, see policy_array
+        """
+        V,best = self._optimal_actions(gamma,epsilon,callback,profile,
+                                       method,stopping,cache)
+        self._keep_solution(gamma,V,best,None)
+        return self.policy_array(best)
+
+    def policy_table(self,gamma,epsilon=1.e-9,method='jacobi',
+                     stopping='residual',cache=None):
+        """
+        Solved policy, values and action values as a PolicyTable
+        :param cache: SolutionCache, see compute_optimal_pi
+        """
+        V,best = self._optimal_actions(gamma,epsilon,None,False,method,
+                                       stopping,cache)
+        self._keep_solution(gamma,V,best,None)
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        return PolicyTable(self.map.cols,self.actions,self.policy_array(best),
+                           V,R+gamma*self.action_values(V))
+
+    def _optimal_actions(self,gamma,epsilon,callback,profile,method,
+                         stopping,cache):
+        # V and the index of the first maximizing action of every cell
+        if callback is not None:
+            start = perf_counter()
+        arrays = None
+        if cache is not None:
+            key = cache.key(self,gamma=gamma,epsilon=epsilon,method=method,
+                            stopping=stopping)
+            arrays = cache.get(key)
+        if arrays is not None:
+            V,P = arrays['V'],arrays['policy']
+            # the stored policy_array has no action outside the accesible
+            # cells, the policy dict has the greedy one of every cell
+            best = np.where(P >= 0,P,self.action_values(V).argmax(axis=0))
+            self.stats = {'cache':'hit'}
+            solved = start if callback is not None else None
+        else:
+            V = self.compute_v_array(gamma,animate=False,epsilon=epsilon,
+                                     callback=callback,profile=profile,
+                                     method=method,stopping=stopping)
+            if callback is not None:
+                solved = perf_counter()
+            Q = self.action_values(V)
+            # first maximizing action, as max() did over self.actions
+            best = Q.argmax(axis=0)
+            if cache is not None:
+                self.stats['cache'] = 'miss'
+                arrays = {'V':V,'policy':self.policy_array(best)}
+                if cache.keep_q:
+                    R = np.asarray(self.map.rewards,dtype=float).ravel()
+                    arrays['Q'] = R+gamma*Q
+                cache.put(key,**arrays)
+        if callback is not None:
+            end = perf_counter()
+            record = {'solver':'compute_optimal_pi','time':end-start}
+            if profile:
+                record['extraction_time'] = end-solved
+            callback(record)
+        return V,best
+
+    def _keep_solution(self,gamma,V,best,pi):
+        # what resolve needs to tell the edits since this solve, pi being
+        # None when only the array was asked for
+        self._solution = {'gamma':gamma,'V':V,'best':best,'pi':pi,
+                          'types':self.model.types.copy(),
+                          'rewards':np.asarray(self.map.rewards,
+                                               dtype=float).ravel(),
+                          'probs_version':self._probs_version}
+
+    def resolve(self,gamma,changed=None,epsilon=1.e-9,callback=None):
+        """
+        Optimal policy after edits of the map, warm-started from the last
+        compute_optimal_pi or resolve. Only the cells around the edits are
+        backed up, the frontier spreading to the neighbours of every cell
+        whose value moved by more than the stopping threshold; a full
+        sweep then checks the same stopping rule as compute_v_array
+        before returning.
+        :param gamma: the discount factor, below 1
+        :param changed: (x,y) cells whose type or reward changed, found by
+        comparing with the last solve if not given
+        :param epsilon: maximum distance to the optimal value function
+        :param callback: called with a record of every frontier step
+        :return: the updated {(x,y):action} policy; the greedy action is
+        recomputed only in the cells next to an edit or to a cell whose
+        value moved
+        """
+        # the frontier spreads and stops on the residual, so gamma < 1
+        threshold = self._threshold(gamma,epsilon,'residual',span=False)
+        solution = self._solution
+        model = self.model
+        n = model.n_states
+        if solution is None or len(solution['V']) != n:
+            return self.compute_optimal_pi(gamma,epsilon,callback)
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        if changed is None:
+            dirty = np.flatnonzero((solution['types'] != model.types)|
+                                   (solution['rewards'] != R))
+        else:
+            dirty = np.array([self.cell_index(c) for c in changed],
+                             dtype=np.intp)
+        if gamma != solution['gamma'] or \
+           self._probs_version != solution['probs_version']:
+            dirty = np.arange(n)
+        V = solution['V'].copy()
+        V[model.terminal] = R[model.terminal]
+        V[model.types == INACCESIBLE] = 0.0
+        accesible = model.accesible
+        kernels = model.kernels
+        targets = model.targets
+
+        cells = np.flatnonzero(accesible)
+        targets_cells = targets[:,cells]
+        # larger frontiers are cheaper to sweep whole
+        limit = len(cells)//16
+        # cells whose value moved by more than the threshold
+        moved = np.zeros(n,dtype=bool)
+
+        def spread(sources):
+            # next frontier, the accesible cells that can move into sources
+            moved[sources] = True
+            if len(sources) > limit:
+                return cells
+            near = np.unique(targets[:,sources])
+            return near[accesible[near]]
+
+        frontier = spread(dirty)
+        steps = sweeps = backups = 0
+        while True:
+            while 0 < len(frontier) <= limit:
+                if callback is not None:
+                    start = perf_counter()
+                Q = kernels @ V[targets[:,frontier]]
+                V_new = R[frontier]+gamma*Q.max(axis=0)
+                delta = np.abs(V_new-V[frontier])
+                V[frontier] = V_new
+                steps += 1
+                backups += frontier.size*self.n_actions
+                if callback is not None:
+                    callback({'solver':'resolve','step':steps,
+                              'frontier':len(frontier),
+                              'residual':float(delta.max()),
+                              'time':perf_counter()-start})
+                frontier = spread(frontier[delta > threshold])
+            # full sweep, checking the stopping rule of compute_v_array on
+            # the values the frontier left behind too
+            if callback is not None:
+                start = perf_counter()
+            Q = kernels @ V[targets_cells]
+            V_new = R[cells]+gamma*Q.max(axis=0)
+            delta = np.abs(V_new-V[cells])
+            V[cells] = V_new
+            steps += 1
+            sweeps += 1
+            backups += V_new.size*self.n_actions
+            error = delta.max(initial=0.0)
+            if callback is not None:
+                callback({'solver':'resolve','step':steps,
+                          'frontier':len(cells),'residual':float(error),
+                          'time':perf_counter()-start})
+            if error <= threshold:
+                break
+            frontier = spread(cells[delta > threshold])
+        # the action values of a cell, obstacles and terminals included,
+        # move with the values of its targets and with the stencil, which
+        # an edit changes in the cells next to it
+        stale = moved[targets].any(axis=0)
+        cols = self.map.cols
+        y,x = np.divmod(dirty,cols)
+        for dx,dy in product([-1,0,1],[-1,0,1]):
+            stale[np.clip(y+dy,0,model.rows-1)*cols+
+                  np.clip(x+dx,0,cols-1)] = True
+        moved = np.flatnonzero(stale)
+        best = solution['best'].copy()
+        best[moved] = (kernels @ V[targets[:,moved]]).argmax(axis=0)
+        if solution['pi'] is None:
+            pi = self.array_to_pi(best)
+        else:
+            # a new dictionary, the one returned before stays as it was
+            pi = dict(solution['pi'])
+            for s,a in zip(moved.tolist(),best[moved].tolist()):
+                pi[(s%cols,s//cols)] = self.actions[a]
+        self.stats = {'steps':steps,'sweeps':sweeps,'backups':backups,
+                      'moved':len(moved)}
+        self._keep_solution(gamma,V,best,pi)
+        return pi
     
     def best_action_Q(self,Q,s):
+        if isinstance(Q,QTable):
+            return self.actions[int(Q.row(s).argmax())]
         return max([(a,Q[(s,a)]) for a in self.actions ],
                     key=lambda x:x[1])[0]
         
-    def q_learn(self,alpha,gamma,episodes,steps):
-        n,m = self.map.cols,self.map.rows
-        cells = [x for x in product(range(n),range(m))\
-                 if self.accesible_cell(x) or self.terminal_cell(x)]
+    def q_learn(self,alpha,gamma,episodes,steps,callback=None):
+        model = self.model
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        terminal = model.terminal
+        states = np.flatnonzero(model.accesible|terminal)
         #initialize with instantaneous reward
-        self.Q = {(s,a):self.reward_of_cell(s) \
-                  for s,a in product(cells,self.actions)}
-        for episode,s in enumerate(choices(cells,k=episodes),1):
-            # instantaneous reward
-            r = self.reward_of_cell(s)
-            for step in range(steps):
-                # explore action
-                a = choice(self.actions)
-                # attempt to move
-                s_p, r_p = self.move(s,a)
-                self.Q[(s,a)] = (1-alpha)*self.Q[(s,a)]+\
-                alpha*(r+gamma*max([self.Q[(s_p,a)] for a in self.actions]))
-                s,r = s_p,r_p
-                if self.terminal_cell(s):
-                    # early termination
+        Q = np.repeat(R[:,None],self.n_actions,axis=1)
+        self.Q = QTable(self.map.cols,self.actions,states,Q)
+        starts = self.rng.generator.choice(states,size=episodes)
+        moves,terminated = _q_learn_episodes(model,R,Q,starts,alpha,gamma,
+                                             steps,self.rng,callback)
+        self.stats = {'episodes':episodes,'moves':moves,
+                      'terminated':terminated}
+        return self.Q.policy()
+
+    def q_learn_replay(self,alpha,gamma,episodes,steps,agents=32,
+                       batch_size=256,updates=2,buffer_size=100000,
+                       epsilon=1.0,epsilon_min=0.05,epsilon_decay=0.999,
+                       alpha_decay=0.6,check_every=100,patience=5,
+                       tolerance=0.03,callback=None):
+        """
+        Q-learning from experience replay: agents agents explore together,
+        their transitions go to a ReplayBuffer and every step of the
+        agents is followed by updates minibatch TD updates of Q, the
+        transitions of a minibatch that share (s,a) averaging their TD
+        errors. Exploration is epsilon-greedy, epsilon decaying by
+        epsilon_decay every step down to epsilon_min (epsilon=1 and
+        epsilon_decay=1 explore uniformly like q_learn). Q starts from the
+        instantaneous rewards and the TD target is that of q_learn.
+        :param alpha: learning rate, the floor of the decaying rate if
+        alpha_decay
+        :param episodes: maximum number of episodes, over all the agents
+        :param steps: maximum number of moves of an episode
+        :param alpha_decay: the rate of a (s,a) updated n times is
+        max(alpha,n**-alpha_decay), 0 for the constant alpha
+        :param check_every: steps of the agents between comparisons of the
+        greedy policy in the accesible cells
+        :param patience: stop once that many comparisons in a row changed
+        at most tolerance of the cells (near ties keep flipping), 0 to run
+        all the episodes
+        :param callback: called with a record of every comparison
+        :return: the greedy policy, as q_learn
+        """
+        model = self.model
+        generator = self.rng.generator
+        R = np.asarray(self.map.rewards,dtype=float).ravel()
+        terminal = model.terminal
+        states = np.flatnonzero(model.accesible|terminal)
+        cells = np.flatnonzero(model.accesible)
+        #initialize with instantaneous reward
+        Q = np.repeat(R[:,None],self.n_actions,axis=1)
+        self.Q = QTable(self.map.cols,self.actions,states,Q)
+        buffer = ReplayBuffer(buffer_size)
+        visits = np.zeros(Q.shape)
+        agents = min(agents,episodes)
+        # episodes start in the accesible cells
+        s = generator.choice(cells,size=agents)
+        running = np.ones(agents,dtype=bool)
+        length = np.zeros(agents,dtype=np.intp)
+        started,finished = agents,0
+        moves = step = stable = 0
+        best = Q[cells].argmax(axis=1)
+        if callback is not None:
+            start = perf_counter()
+        while running.any():
+            eps = max(epsilon_min,epsilon*epsilon_decay**step)
+            active = np.flatnonzero(running)
+            s_a = s[active]
+            a = Q[s_a].argmax(axis=1)
+            explore = generator.random(len(active)) < eps
+            a[explore] = generator.integers(self.n_actions,
+                                            size=int(explore.sum()))
+            s_p = model.sample_batch(s_a,a,self.rng.take(len(active)))
+            buffer.add(s_a,a,R[s_a],s_p)
+            s[active] = s_p
+            length[active] += 1
+            moves += len(active)
+            step += 1
+            for _ in range(updates):
+                bs,ba,br,bs_p = buffer.sample(batch_size,generator)
+                td = br+gamma*Q[bs_p].max(axis=1)-Q[bs,ba]
+                # transitions sharing (s,a) average their TD errors
+                key,inverse,counts = np.unique(bs*self.n_actions+ba,
+                                               return_inverse=True,
+                                               return_counts=True)
+                if alpha_decay:
+                    visits.ravel()[key] += 1
+                    rate = np.maximum(alpha,visits.ravel()[key]**-alpha_decay)
+                else:
+                    rate = alpha
+                Q.ravel()[key] += rate*np.bincount(inverse,weights=td)/counts
+            ended = active[terminal[s_p]|(length[active] >= steps)]
+            if len(ended):
+                finished += len(ended)
+                running[ended] = False
+                # restarted while episodes remain
+                restart = ended[:episodes-started]
+                started += len(restart)
+                s[restart] = generator.choice(cells,size=len(restart))
+                length[restart] = 0
+                running[restart] = True
+            if step%check_every == 0:
+                best_prev,best = best,Q[cells].argmax(axis=1)
+                changes = int(np.count_nonzero(best != best_prev))
+                stable = stable+1 if changes <= tolerance*len(cells) else 0
+                if callback is not None:
+                    callback({'solver':'q_learn_replay','step':step,
+                              'moves':moves,'episodes':finished,
+                              'epsilon':eps,'policy_changes':changes,
+                              'time':perf_counter()-start})
+                if patience and stable >= patience:
                     break
-        return {s:self.best_action_Q(self.Q,s) for s in cells}
-
-#Visualizar los datos en el documento problem-1.mdp exportando de URL-GitHub
-import pandas as pd
-url = "https://raw.githubusercontent.com/riiaa/MDP_and_RL/master/problem-2.mdp"
-m = pd.read_csv(url)
-m
-
-#Cargar los datos con la función MDFWorld que nos permite separar el espacio en "tipos" y "recompensas"
-m = MDPWorld('problem-2.mdp')
+        self.stats = {'episodes':finished,'moves':moves,'steps':step,
+                      'updates':step*updates,
+                      'converged':bool(patience and stable >= patience)}
+        return self.Q.policy()
 
-m.map.show()
-
-v= m.compute_v(1.animate=TRUE, epsilon=1.e-6)
-
-pi=m.random_pi()
-m.simulate()
+    def q_learn_parallel(self,alpha,gamma,episodes,steps,workers=None,
+                         seed=None,merge='average'):
+        """
+        q_learn with the episodes split over a process pool. Every worker
+        learns its own table from the instantaneous rewards.
+        :param workers: number of processes, os.cpu_count() by default
+        :param seed: seed of the worker streams, drawn from self.rng if
+        not given
+        :param merge: 'average' to average the worker tables into self.Q,
+        None to keep the list of worker QTables in self.Qs
+        :return: greedy policy of the merged table (of the first worker
+        table if merge is None)
+        """
+        if merge not in ('average',None):
+            raise ValueError('unknown merge: '+str(merge))
+        if episodes < 1:
+            raise ValueError('q_learn_parallel needs at least one episode')
+        workers = workers or os.cpu_count()
+        chunks = [episodes//workers+(i < episodes%workers) \
+                  for i in range(workers)]
+        seeds = self._spawn_seeds(seed,workers)
+        tasks = [(alpha,gamma,n,steps,s) for n,s in zip(chunks,seeds) if n]
+        results = self._run_pool(tasks,workers)
+        model = self.model
+        states = np.flatnonzero(model.accesible|model.terminal)
+        tables = [QTable(self.map.cols,self.actions,states,Q) \
+                  for Q,_ in results]
+        if merge is None:
+            self.Qs = tables
+            return tables[0].policy()
+        Q = np.mean([t.values for t in tables],axis=0)
+        self.Q = QTable(self.map.cols,self.actions,states,Q)
+        return self.Q.policy()
+
+    def q_learn_sweep(self,configs,workers=None,seed=None,reference=None):
+        """
+        Runs q_learn for every configuration, one process pool task each
+        :param configs: dictionaries with alpha, gamma, episodes and steps
+        :param reference: policy dict the learned policies are compared to
+        :return: one row per configuration, the configuration plus policy,
+        time, env_steps, terminated (fraction of episodes ending in a
+        terminal cell) and, with a reference, agreement (fraction of
+        accesible cells with the reference action)
+        """
+        configs = list(configs)
+        seeds = self._spawn_seeds(seed,len(configs))
+        tasks = [(c['alpha'],c['gamma'],c['episodes'],c['steps'],s) \
+                 for c,s in zip(configs,seeds)]
+        results = self._run_pool(tasks,workers)
+        model = self.model
+        states = np.flatnonzero(model.accesible|model.terminal)
+        table = []
+        for config,(Q,stats) in zip(configs,results):
+            row = dict(config)
+            row['policy'] = QTable(self.map.cols,self.actions,states,Q).policy()
+            row.update(stats)
+            row['terminated'] = stats['terminated']/max(config['episodes'],1)
+            if reference is not None:
+                cells = [c for c in row['policy'] if self.accesible_cell(c)]
+                row['agreement'] = sum(row['policy'][c] == reference[c] \
+                                       for c in cells)/max(len(cells),1)
+            table.append(row)
+        return table
+
+    def _spawn_seeds(self,seed,n):
+        if seed is None:
+            seed = int(self.rng.generator.integers(2**63))
+        return np.random.SeedSequence(seed).spawn(n)
+
+    def _run_pool(self,tasks,workers):
+        from concurrent.futures import ProcessPoolExecutor
+        # the model is shared with the workers, only the tasks are pickled
+        with SharedWorld(self) as shared:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_attach_worker,
+                                     initargs=(shared.spec,)) as pool:
+                return list(pool.map(_q_learn_task,tasks))
+
+def _q_learn_episodes(model,R,Q,starts,alpha,gamma,steps,rng,callback=None):
+    """
+    Q-learning episodes with uniformly random exploration, updating Q in
+    place
+    :param model: TransitionModel of the world
+    :param R: flat rewards
+    :param Q: (n_states,n_actions) table
+    :param starts: start state of every episode
+    :param rng: RandomStream
+    :param callback: called with a record of every episode
+    :return: number of moves and of episodes ending in a terminal cell
+    """
+    terminal = model.terminal
+    n_actions = model.n_actions
+    moves = terminated = 0
+    for episode,s in enumerate(np.asarray(starts).tolist(),1):
+        # instantaneous reward
+        r = R[s]
+        cumreward = r
+        done = False
+        for step in range(steps):
+            # explore action
+            a = rng.randrange(n_actions)
+            # attempt to move
+            s_p = model.sample(s,a,rng.random())
+            Q[s,a] = (1-alpha)*Q[s,a]+alpha*(r+gamma*Q[s_p].max())
+            s,r = s_p,R[s_p]
+            cumreward += r
+            moves += 1
+            if terminal[s]:
+                # early termination
+                terminated += 1
+                done = True
+                break
+        if callback is not None:
+            callback({'solver':'q_learn','episode':episode,
+                      'return':float(cumreward),'length':step+1 if steps else 0,
+                      'terminated':done})
+    return moves,terminated
+
+def share_arrays(arrays):
+    """
+    Copies arrays into a new shared memory block
+    :param arrays: dictionary from name to array
+    :return: the shared memory handle, to be closed and unlinked by the
+    caller, and the spec other processes pass to attach_arrays
+    """
+    layout,size = {},0
+    for name,a in arrays.items():
+        # 64 byte aligned offsets
+        size = -(-size//64)*64
+        layout[name] = (size,a.dtype.str,a.shape)
+        size += a.nbytes
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(create=True,size=max(size,1))
+    for name,a in arrays.items():
+        offset,dtype,shape = layout[name]
+        np.ndarray(shape,dtype,buffer=shm.buf,offset=offset)[...] = a
+    return shm,{'name':shm.name,'layout':layout}
+
+def attach_arrays(spec):
+    """
+    :return: the shared memory handle and the dictionary of arrays backed
+    by the block of spec (see share_arrays); the arrays must be deleted
+    before the handle is closed
+    """
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    return shm,{name:np.ndarray(shape,dtype,buffer=shm.buf,offset=offset) \
+                for name,(offset,dtype,shape) in spec['layout'].items()}
+
+class SharedWorld:
+    """
+    Read-only copy of the compiled model and rewards of a world in one
+    shared memory block. Used as a context manager by the parent process,
+    which unlinks the block on exit; workers map it with attach(spec).
+    """
+
+    def __init__(self,world):
+        model = world.model
+        self.shm,self.spec = share_arrays(
+            {'types':model.types.reshape(model.rows,model.cols),
+             'rewards':np.asarray(world.map.rewards,dtype=float).ravel(),
+             'kernels':model.kernels,
+             'targets':model.targets})
+
+    @staticmethod
+    def attach(spec):
+        """
+        :return: the shared memory handle, a TransitionModel and the flat
+        rewards, all backed by the shared block
+        """
+        shm,a = attach_arrays(spec)
+        model = TransitionModel(a['types'],a['kernels'],targets=a['targets'])
+        return shm,model,a['rewards']
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+# state of a pool worker, set by _attach_worker
+_worker = None
+
+def _attach_worker(spec):
+    global _worker
+    _worker = SharedWorld.attach(spec)
+
+def _q_learn_task(task):
+    alpha,gamma,episodes,steps,seed = task
+    _,model,R = _worker
+    states = np.flatnonzero(model.accesible|model.terminal)
+    rng = RandomStream(seed)
+    #initialize with instantaneous reward
+    Q = np.repeat(R[:,None],model.n_actions,axis=1)
+    start = perf_counter()
+    starts = rng.generator.choice(states,size=episodes)
+    moves,terminated = _q_learn_episodes(model,R,Q,starts,alpha,gamma,
+                                         steps,rng)
+    return Q,{'time':perf_counter()-start,'env_steps':moves,
+              'terminated':terminated}
+
+def _strip_worker(spec,index,r0,r1,kernels,gamma,threshold,barrier):
+    """
+    Process of compute_v_parallel backing up rows r0:r1, see _strip_sweeps
+    """
+    shm,a = attach_arrays(spec)
+    try:
+        _strip_sweeps(a,index,r0,r1,kernels,gamma,threshold,barrier)
+    except BaseException:
+        # the other processes would wait for this one forever
+        barrier.abort()
+        raise
+    a.clear()
+    shm.close()
+
+def _strip_sweeps(a,index,r0,r1,kernels,gamma,threshold,barrier):
+    """
+    Jacobi sweeps of rows r0:r1. A sweep reads V[sweep%2], including the
+    halo rows of the neighbouring strips, and writes V[(sweep+1)%2] and
+    its residual; after the barrier every process takes the same stopping
+    decision from all the residuals.
+    """
+    types,R,V,residual = a['types'],a['rewards'],a['V'],a['residual']
+    rows,cols = types.shape
+    # rows backed up at a time, few enough for the temporaries to stay in
+    # cache, with the halo rows and stay_probs of each chunk
+    chunk = max(1,4096//cols)
+    blank = np.zeros((1,cols))
+    chunks = []
+    for c0 in range(r0,r1,chunk):
+        c1 = min(c0+chunk,r1)
+        lo,hi = max(c0-1,0),min(c1+1,rows)
+        # halo rows outside the grid are blocked
+        top,bottom = blank[:int(lo == c0)],blank[:int(hi == c1)]
+        strip_types = np.concatenate([top+INACCESIBLE,types[lo:hi],
+                                      bottom+INACCESIBLE])
+        chunks.append((c0,c1,lo,hi,top,bottom,strip_types,
+                       stay_probs(strip_types,kernels)))
+    sweep = 0
+    while True:
+        V_old,V_new = V[sweep%2],V[(sweep+1)%2]
+        error = 0.0
+        for c0,c1,lo,hi,top,bottom,strip_types,stay in chunks:
+            V_strip = np.concatenate([top,V_old[lo:hi],bottom])
+            backed_up = backup_rows(V_strip,strip_types,R[c0:c1],kernels,
+                                    gamma,stay)
+            error = max(error,np.abs(backed_up-V_strip[1:-1]).max())
+            V_new[c0:c1] = backed_up
+        residual[sweep%2,index] = error
+        barrier.wait()
+        if residual[sweep%2].max() <= threshold:
+            return
+        sweep += 1
+
+def demo_mdp_world():
+    #Visualizar los datos en el documento problem-1.mdp exportando de URL-GitHub
+    import pandas as pd
+    url = "https://raw.githubusercontent.com/riiaa/MDP_and_RL/master/problem-2.mdp"
+    m = pd.read_csv(url)
+    print(m)
+
+    #Cargar los datos con la función MDFWorld que nos permite separar el espacio en "tipos" y "recompensas"
+    m = MDPWorld('problem-2.mdp')
+
+    m.map.show(m.probs)
+
+    #Con gamma=1 el residuo no acota el error: se detiene con el span
+    v= m.compute_v(1,animate=True, epsilon=1.e-6, stopping='span')
+
+    pi=m.random_pi()
+    m.simulate(pi,100)
+
+if __name__ == '__main__':
+    demo_markov_chain()
+    demo_mdp()
+    demo_mdp_world()
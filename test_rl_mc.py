@@ -0,0 +1,169 @@
+import os
+from itertools import product
+from math import inf
+
+import numpy as np
+import pytest
+
+import rl_mc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROBLEMS = [os.path.join(HERE,name) \
+            for name in ['problem.mdp','problem-2.mdp']]
+GAMMA = 0.9
+EPSILON = 1.e-9
+
+
+def reference_v(world,gamma,epsilon):
+    # the dictionary value iteration the array solvers replaced
+    error = inf
+    V = {cell:0.0 \
+         if not world.terminal_cell(cell) else world.reward_of_cell(cell) \
+         for cell in product(range(world.map.cols),range(world.map.rows))}
+    while error > epsilon*(1-gamma)/gamma:
+        V_prev = V.copy()
+        for cell in filter(lambda x:world.accesible_cell(x),V.keys()):
+            V[cell] = world.reward_of_cell(cell)+ \
+            gamma*max([world.expected_reward(cell,action,V) \
+                       for action in world.actions])
+        error = max([abs(V[k]-V_prev[k]) for k in V.keys()])
+    return V
+
+def reference_pi(world,V):
+    return {cell:max([(action,world.expected_reward(cell,action,V)) \
+                      for action in world.actions],key=lambda c:c[1])[0] \
+            for cell in V}
+
+def as_array(world,V):
+    return np.array([V[(s%world.map.cols,s//world.map.cols)] \
+                     for s in range(world.model.n_states)])
+
+@pytest.fixture(params=PROBLEMS)
+def world(request):
+    return rl_mc.MDPWorld(request.param,seed=0)
+
+
+def test_compute_v_matches_reference(world):
+    V = reference_v(world,GAMMA,EPSILON)
+    values = world.compute_v(GAMMA,epsilon=EPSILON)
+    assert values.keys() == V.keys()
+    for cell,v in V.items():
+        assert values[cell] == pytest.approx(v,abs=1.e-7)
+    # the actions of terminal cells tie exactly, only the others count
+    pi = world.compute_optimal_pi(GAMMA,epsilon=EPSILON)
+    reference = reference_pi(world,V)
+    for cell in filter(world.accesible_cell,V):
+        assert pi[cell] == reference[cell]
+
+@pytest.mark.parametrize('method',['jacobi','gauss-seidel','sor','anderson'])
+def test_methods_agree(world,method):
+    V = as_array(world,reference_v(world,GAMMA,EPSILON))
+    np.testing.assert_allclose(
+        world.compute_v_array(GAMMA,epsilon=EPSILON,method=method),V,
+        atol=1.e-7)
+
+def test_other_solvers_agree(world):
+    V = world.compute_v_array(GAMMA,epsilon=EPSILON)
+    np.testing.assert_allclose(world.anderson_iteration(GAMMA,EPSILON),V,
+                               atol=1.e-7)
+    np.testing.assert_allclose(world.prioritized_sweeping(GAMMA,EPSILON),V,
+                               atol=1.e-7)
+    np.testing.assert_allclose(world.compute_v_tiled(GAMMA).ravel(),V,
+                               atol=1.e-4)
+
+def test_sweep_counts(world):
+    world.compute_v_array(GAMMA,epsilon=EPSILON)
+    sweeps = world.stats['sweeps']
+    V = world.compute_v_array(GAMMA,epsilon=EPSILON)
+    batch = world.compute_v_batch([GAMMA,GAMMA,0.8],epsilon=EPSILON)
+    assert world.stats['sweeps'][:2] == [sweeps,sweeps]
+    np.testing.assert_array_equal(batch[:,0],V)
+    np.testing.assert_array_equal(batch[:,1],V)
+    np.testing.assert_allclose(
+        batch[:,2],world.compute_v_array(0.8,epsilon=EPSILON),atol=1.e-12)
+    parallel = world.compute_v_parallel(GAMMA,EPSILON,workers=2)
+    assert world.stats['sweeps'] == sweeps
+    np.testing.assert_allclose(parallel,V,atol=1.e-12)
+
+def test_batch_policies(world):
+    gammas = [0.8,GAMMA]
+    V,policies = world.compute_optimal_pi_batch(gammas,epsilon=EPSILON)
+    for gamma,pi in zip(gammas,policies):
+        assert pi == world.compute_optimal_pi(gamma,epsilon=EPSILON)
+
+def test_seeded_runs_repeat():
+    runs = []
+    for _ in range(2):
+        world = rl_mc.MDPWorld(PROBLEMS[0],seed=3)
+        Q = world.q_learn(0.1,GAMMA,50,100)
+        runs.append((dict(Q),world.stats))
+    assert runs[0] == runs[1]
+
+def test_edited_map_is_seen(world):
+    world.compute_v_array(GAMMA)
+    types = np.array(world.map.types)
+    rewards = np.array(world.map.rewards)
+    rewards[types == rl_mc.ACCESIBLE] = -0.5
+    world.map.rewards = rewards
+    fresh = rl_mc.MDPWorld.from_arrays(types,rewards,world.probs)
+    np.testing.assert_array_equal(world.compute_v_array(GAMMA),
+                                  fresh.compute_v_array(GAMMA))
+    with pytest.raises(ValueError):
+        world.map.rewards[0,0] = 1.0
+    with pytest.raises(TypeError):
+        world.probs['N'] = np.eye(3)
+
+def test_resolve_matches_fresh_solve():
+    world = rl_mc.generate_world(150,150,seed=1)
+    world.compute_optimal_pi(0.95)
+    types = np.array(world.map.types)
+    rewards = np.array(world.map.rewards)
+    # edits next to obstacles, whose greedy action moves too
+    rng = np.random.default_rng(1)
+    obstacles = np.argwhere(types == rl_mc.INACCESIBLE)
+    for y,x in obstacles[rng.choice(len(obstacles),5)]:
+        for dy,dx in [(0,1),(1,0),(0,-1),(-1,0)]:
+            if 0 <= y+dy < 150 and 0 <= x+dx < 150 and \
+               types[y+dy,x+dx] == rl_mc.ACCESIBLE:
+                rewards[y+dy,x+dx] = -1.0
+                break
+    world.map.rewards = rewards
+    pi = world.resolve(0.95)
+    assert pi == world.compute_optimal_pi(0.95)
+
+def test_transition_arrays_follow_T():
+    T = {(0,0,'x'):1.0,(1,1,'x'):1.0,(0,1,'y'):1.0,(1,1,'y'):1.0}
+    mdp = rl_mc.MDP([0,1],[0.0,1.0],['x','y'],T,GAMMA)
+    assert mdp.policy_iteration(['x','x']) == ['y','x']
+    T[(0,0,'x')],T[(0,1,'x')] = 0.0,1.0
+    T[(0,0,'y')],T[(0,1,'y')] = 1.0,0.0
+    assert mdp.policy_iteration(['y','x']) == ['x','x']
+
+def test_solution_cache(world,tmp_path):
+    cache = rl_mc.SolutionCache(str(tmp_path))
+    pi = world.compute_optimal_pi(GAMMA,cache=cache)
+    assert world.stats['cache'] == 'miss'
+    assert world.compute_optimal_pi(GAMMA,cache=cache) == pi
+    assert world.stats['cache'] == 'hit'
+    key = cache.key(world,gamma=GAMMA,epsilon=EPSILON,method='jacobi',
+                    stopping='residual')
+    with open(cache.path(key),'wb') as f:
+        f.write(b'PK\x03\x04')
+    assert cache.get(key) is None
+    assert world.compute_optimal_pi(GAMMA,cache=cache) == pi
+    assert world.stats['cache'] == 'miss'
+    # other rewards, another entry
+    rewards = np.array(world.map.rewards)
+    rewards[world.map.types == rl_mc.ACCESIBLE] = -0.5
+    world.map.rewards = rewards
+    world.compute_optimal_pi(GAMMA,cache=cache)
+    assert world.stats['cache'] == 'miss'
+
+@pytest.mark.parametrize('cell',['1_0','0x0','abc'])
+def test_malformed_map_rows(tmp_path,cell):
+    lines = open(PROBLEMS[0]).read().splitlines()
+    lines[2] = lines[2].replace('0  0.00',cell+' 0.00',1)
+    path = tmp_path/'bad.mdp'
+    path.write_text('\n'.join(lines)+'\n')
+    with pytest.raises(ValueError,match=r'bad\.mdp:3: '):
+        rl_mc.parse_mdp(str(path))